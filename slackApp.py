@@ -1,65 +1,209 @@
 import json
-from slack_sdk import WebClient
-from slack_sdk.signature import SignatureVerifier
+from slack_sdk.web.async_client import AsyncWebClient
 import os
-import sys
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request, Response, Depends
 import time
 from slack_sdk.errors import SlackApiError
 from fastapi import HTTPException
-from fastapi.responses import JSONResponse
-import requests
-from datetime import datetime, timedelta
+from fastapi.responses import JSONResponse, PlainTextResponse
+import httpx
+import aiohttp
 import uuid
 from ..... import execute_bot
 from ..... import fetch_slack_credentials_for_bot_key
 import logging
-import tempfile
-import re
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+from .slackWorkers import EventWorkerPool
+from .slackStores import create_store
+from .slackUsers import UserProfileCache
+from .slackThreads import ThreadOwnershipIndex, extract_mentions
+from .slackFiles import StreamingFileUpload
+from .slackBlocks import ImageValidator, build_messages
+from .slackRegistry import BotRegistry
+from .slackRateLimits import RateLimitScheduler, RateLimitedClient
+from .slackMetrics import Metrics
+from .slackStreaming import StreamingReply, iter_bot_response
+from .slackLogging import configure_logging, bind_event, log_payload
+from .slackRouting import IGNORE, owner_of, route_event
+from .slackSocketMode import SocketModeDispatcher
+from .slackContext import ThreadContextStore
+from .slackJournal import EventProgress, create_event_journal
 
 
 load_dotenv()
 
-# Configure logging since I was deploying to Azure container app and I need to see the logs
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout) 
-    ]
-)
+# Configure logging since I was deploying to Azure container app and I need to see the logs,
+# SLACK_LOG_FORMAT=json for structured logs, lines are written from a background thread
+configure_logging()
 logger = logging.getLogger(__name__)
 #Using FastAPI
 app = FastAPI()
 
-# Dictionary to store bot clients
-bot_clients = {}
-signature_verifiers = {}
-bot_credentials = {}
+# Events already accepted, keyed by (token_key, event_id) so the same retried event is only processed once,
+# use the redis backend to share this between replicas
+processed_events = create_store("dedup", ttl_seconds=3600, max_entries=50000)
+
+# "background" acks the event right away and processes it in the worker pool, "inline" processes it before responding
+DISPATCH_MODE = os.getenv('SLACK_DISPATCH_MODE', 'background')
+MAX_WORKERS = int(os.getenv('SLACK_MAX_WORKERS', '16'))
+event_worker_pool = EventWorkerPool(
+    max_workers=MAX_WORKERS,
+    max_pending=int(os.getenv('SLACK_MAX_PENDING_EVENTS', '500')),
+    per_bot_concurrency=int(os.getenv('SLACK_PER_BOT_CONCURRENCY', '4'))
+)
 
-# Dictionary to store processed message IDs to avoid duplicate processing
-processed_messages = set()
+# execute_bot and the readers of streamed bot responses hold a thread for the whole answer. They get a pool of their own
+# sized from the worker pool, the loop's default executor has only min(32, cpus + 4) threads and would cap them instead
+bot_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('SLACK_BOT_THREADS', str(MAX_WORKERS + 4))),
+    thread_name_prefix="slack-bot"
+)
 
+# Bot/human flag for mentioned users per workspace, warmed with users.list the first time we need it for a workspace
+user_profiles = UserProfileCache()
+WARM_USER_CACHE = os.getenv('SLACK_WARM_USER_CACHE', 'true').lower() == 'true'
 
-def get_or_create_client(token_key: str):
-    # Return existing client if already initialized
-    if token_key in bot_clients:
-        logger.info(f"Returning existing bot for token key without DB Fetch: {token_key}")
-        return bot_clients[token_key], signature_verifiers[token_key], bot_credentials[token_key]
-    
-    try:
-        # Get credentials from database, bot's token key etc
-        bot_creds = fetch_slack_credentials_for_bot_key(token_key)
-        
-        # Initialize new client with database credentials, we need slack token and signing secret for connecting to slack bot
-        bot_clients[token_key] = WebClient(token=bot_creds['slack_token'])
-        signature_verifiers[token_key] = SignatureVerifier(bot_creds['signing_secret'])
-        bot_credentials[token_key] = bot_creds
-        return bot_clients[token_key], signature_verifiers[token_key], bot_credentials[token_key]
-    except Exception as e:
-        logger.error(f"Error getting bot credentials(slack) for {token_key}: {str(e)}")
-        return None, None, None
+# Original mentions and last responding bot per (channel, thread_ts), shared by all the bots of this deployment
+thread_index = ThreadOwnershipIndex()
+
+# Limits for files downloaded from slack and streamed to the bot's file upload API
+MAX_FILE_BYTES = int(os.getenv('SLACK_MAX_FILE_BYTES', str(50 * 1024 * 1024)))
+FILE_TIMEOUT = float(os.getenv('SLACK_FILE_TIMEOUT_SECONDS', '60'))
+
+# file_path returned by the bot's file upload API per (token_key, slack file_id)
+uploaded_files = create_store("files", ttl_seconds=24 * 3600, max_entries=10000)
+
+# Image urls in bot responses are checked together under this deadline, results are cached
+image_validator = ImageValidator()
+IMAGE_CHECK_DEADLINE = float(os.getenv('SLACK_IMAGE_CHECK_DEADLINE_SECONDS', '5'))
+
+# Stream the bot's answer into the "thinking" message with chat.update calls, at most one per interval
+STREAM_RESPONSES = os.getenv('SLACK_STREAM_RESPONSES', 'false').lower() == 'true'
+STREAM_UPDATE_INTERVAL = float(os.getenv('SLACK_STREAM_UPDATE_INTERVAL_SECONDS', '1'))
+
+# Per bot, per method token buckets for slack API calls, and a per bot budget where replies are sent before lookups
+rate_limit_scheduler = RateLimitScheduler(
+    max_retries=int(os.getenv('SLACK_RATE_LIMIT_RETRIES', '3')),
+    bot_calls_per_second=float(os.getenv('SLACK_RATE_LIMIT_BOT_CALLS_PER_SECOND', '20'))
+)
+
+# SLACK_EVENT_JOURNAL=true writes every accepted event to a journal (SQLite, or redis for several replicas) before acking
+# it, events whose replica stopped before finishing them are claimed and processed by this or another replica
+event_journal = create_event_journal()
+JOURNAL_MAX_ATTEMPTS = int(os.getenv('SLACK_EVENT_JOURNAL_MAX_ATTEMPTS', '3'))
+JOURNAL_CLAIM_INTERVAL = float(os.getenv('SLACK_EVENT_JOURNAL_CLAIM_SECONDS', '30'))
+journal_replay = None
+
+# Recent turns and uploaded file paths per (token_key, channel, thread_uuid), sent to the bot with follow-up questions
+thread_contexts = ThreadContextStore(
+    max_turns=int(os.getenv('SLACK_CONTEXT_MAX_TURNS', '20')),
+    max_turn_chars=int(os.getenv('SLACK_CONTEXT_MAX_TURN_CHARS', '4000'))
+)
+
+# SLACK_COORDINATED_ROUTING=true makes all bots share one decision per message (channel, ts) on which bot answers,
+# use the redis store backend when the bots run in several replicas
+COORDINATED_ROUTING = os.getenv('SLACK_COORDINATED_ROUTING', 'false').lower() == 'true'
+route_decisions = create_store("routes", ttl_seconds=3600, max_entries=50000)
+
+# Slack app id -> token key for the shared /slack/events route, e.g. "A0123:bot_one,A0456:bot_two"
+APP_TOKEN_KEYS = dict(
+    pair.strip().split(':', 1) for pair in os.getenv('SLACK_APP_TOKEN_KEYS', '').split(',') if ':' in pair
+)
+
+# Per stage timers and event outcomes served on /metrics, SLACK_OTEL_ENABLED also exports the stages as OpenTelemetry spans
+metrics = Metrics(
+    enabled=os.getenv('SLACK_METRICS_ENABLED', 'true').lower() == 'true',
+    otel_enabled=os.getenv('SLACK_OTEL_ENABLED', 'false').lower() == 'true'
+)
+
+# Shared connection pools for all bots, created on first use inside the event loop
+http_client = None
+slack_session = None
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT_SECONDS', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', '5'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+# Slack Web API base url, only changed for proxies or the benchmark's fake slack API
+SLACK_API_URL = os.getenv('SLACK_API_URL', AsyncWebClient.BASE_URL)
+try:
+    import h2  # noqa: F401, only needed for HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # One pooled client with keep-alive for file downloads/uploads and image checks, HTTP/2 when h2 is installed
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2),
+            follow_redirects=True
+        )
+    return http_client
+
+def get_slack_session() -> aiohttp.ClientSession:
+    # The slack sdk's async client runs on aiohttp, all bots share this session so they share its connection pool
+    global slack_session
+    if slack_session is None or slack_session.closed:
+        slack_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return slack_session
+
+async def close_http_clients():
+    global http_client, slack_session
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if slack_session is not None:
+        await slack_session.close()
+        slack_session = None
+
+def create_bot_client(token_key: str, slack_token: str) -> RateLimitedClient:
+    # Every slack call of the bot goes through the shared rate limit scheduler
+    return RateLimitedClient(
+        AsyncWebClient(
+            token=slack_token,
+            base_url=SLACK_API_URL,
+            session=get_slack_session(),
+            timeout=int(HTTP_TIMEOUT)
+        ),
+        rate_limit_scheduler,
+        token_key
+    )
+
+# Clients, signature verifiers, credentials and bot user ids of all bots
+bot_registry = BotRegistry(
+    fetch_slack_credentials_for_bot_key,
+    create_bot_client,
+    ttl_seconds=float(os.getenv('SLACK_CREDENTIALS_TTL_SECONDS', '3600')),
+    negative_ttl_seconds=float(os.getenv('SLACK_CREDENTIALS_NEGATIVE_TTL_SECONDS', '30'))
+)
+
+# SLACK_SOCKET_MODE=true receives the events of bots with an app_token over Socket Mode instead of HTTP
+SOCKET_MODE = os.getenv('SLACK_SOCKET_MODE', 'false').lower() == 'true'
+# accept_slack_event is defined further down
+socket_mode_dispatcher = SocketModeDispatcher(bot_registry, lambda *args: accept_slack_event(*args))
+
+def configured_token_keys():
+    # SLACK_BOT_TOKEN_KEYS lists the bots of this deployment, comma separated
+    return [key.strip() for key in os.getenv('SLACK_BOT_TOKEN_KEYS', '').split(',') if key.strip()]
+
+async def prewarm_bots():
+    token_keys = configured_token_keys()
+    if token_keys:
+        await bot_registry.prewarm(token_keys)
+
+async def start_socket_mode():
+    if SOCKET_MODE:
+        await socket_mode_dispatcher.start(configured_token_keys())
 
 # This is the route that will handle the Slack events
 def setup_slack_routes(app: FastAPI):
@@ -67,66 +211,412 @@ def setup_slack_routes(app: FastAPI):
     Sets up Slack routes for the FastAPI application, token key is the bot key, we have different routes for different bots
     """
     app.post("/slack/events/{token_key}")(handle_slack_events)
+    app.post("/slack/events")(handle_shared_slack_events)
+    app.get("/metrics")(metrics_endpoint)
+    app.on_event("startup")(prewarm_bots)
+    app.on_event("startup")(start_socket_mode)
+    app.on_event("startup")(start_journal_replay)
+    app.on_event("shutdown")(socket_mode_dispatcher.stop)
+    app.on_event("shutdown")(drain_event_worker_pool)
+    app.on_event("shutdown")(close_event_journal)
+    app.on_event("shutdown")(close_http_clients)
     return app
 
-#@app.post("/slack/events/{token_key}")
-async def handle_slack_events(token_key: str, request: Request):
-    logger.info(f"request: {request}")
+async def drain_event_worker_pool():
+    # Finish the events we already acked before the container goes away
+    await event_worker_pool.drain(timeout=float(os.getenv('SLACK_WORKER_DRAIN_TIMEOUT', '30')))
+    logger.info("Worker pool drained: %s", event_worker_pool.metrics())
+    bot_executor.shutdown(wait=False)
+
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def collect_runtime_metrics():
+    # Numbers the caches, worker pool and rate limit scheduler already keep, read when /metrics is scraped
+    caches = {
+        "dedup": processed_events,
+        "files": uploaded_files,
+        "users": user_profiles.store,
+        "threads": thread_index.store,
+        "images": image_validator.store,
+    }
+    cache_samples = {}
+    for name, store in caches.items():
+        cache_samples[(name, "hit")] = store.hits
+        cache_samples[(name, "miss")] = store.misses
+    pool = event_worker_pool.metrics()
+    scheduler = rate_limit_scheduler.metrics()
+    return [
+        ("slack_cache_requests_total", "counter", "Cache lookups by cache and result", ("cache", "result"), cache_samples),
+        ("slack_thread_fetches_total", "counter", "Threads fetched from slack because they were not in the thread index", (), {(): thread_index.misses}),
+        ("slack_worker_pending", "gauge", "Events accepted and not finished yet", (), {(): pool["pending"]}),
+        ("slack_worker_in_flight", "gauge", "Events being processed", (), {(): pool["in_flight"]}),
+        ("slack_worker_rejected_total", "counter", "Events rejected because the worker pool was full", (), {(): pool["rejected"]}),
+        ("slack_api_calls_total", "counter", "Slack API calls made through the rate limit scheduler", (), {(): scheduler["calls"]}),
+        ("slack_api_throttled_total", "counter", "Slack API calls that waited for a rate limit token", (), {(): scheduler["throttled"]}),
+        ("slack_api_rate_limited_total", "counter", "Slack API calls answered with 429", (), {(): scheduler["rate_limited"]}),
+    ]
+
+metrics.add_collector(collect_runtime_metrics)
+
+def parse_slack_payload(body: bytes) -> dict:
+    # Every slack event payload is a JSON object, anything else is a bad request and not a 500
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    return payload
+
+def check_signature_headers(source: str, request: Request):
+    """
+    The cheap checks, they don't even need the bot's signing secret: both signature headers are there and the request
+    isn't too old. Returns (timestamp, signature)
+    """
+    timestamp = request.headers.get('X-Slack-Request-Timestamp', '')
+    signature = request.headers.get('X-Slack-Signature', '')
+
+    if not timestamp.isdigit() or not signature:
+        logger.error("Missing slack signature headers for %s", source)
+        raise HTTPException(status_code=401, detail="Missing request signature")
+    # Verify request is not too old
+    if abs(time.time() - int(timestamp)) > 60 * 5:
+        logger.error("Request too old for %s: %s", source, timestamp)
+        raise HTTPException(status_code=401, detail="Request too old")
+    return timestamp, signature
+
+async def check_slack_signature(token_key: str, request: Request, body: bytes):
+    """
+    Rejects forged or stale requests without any slack API call, raises HTTPException unless the body was signed
+    with the bot's signing secret
+    """
+    timestamp, signature = check_signature_headers(token_key, request)
+
+    bot = await bot_registry.get(token_key)
+    if not bot:
+        logger.info("Bot %s not found in configuration", token_key)
+        raise HTTPException(status_code=404, detail="Bot not found")
+
+    # Verify the request signature
+    if not bot.signature_verifier.is_valid(
+        body=body,
+        timestamp=timestamp,
+        signature=signature
+    ):
+        logger.error("Invalid request signature")
+        raise HTTPException(status_code=401, detail="Invalid request signature")
+
+async def verify_slack_request(token_key: str, request: Request) -> dict:
+    """
+    FastAPI dependency that verifies the slack signature before anything else runs, forged or stale requests are
+    rejected without any slack API call. Returns the payload, parsed once from the raw body that was verified.
+    """
     body = await request.body()
-    logger.info(f"body: {body}")
+    await check_slack_signature(token_key, request, body)
+    return parse_slack_payload(body)
 
-    payload = await request.json()
-    logger.info(f"payload: {payload}")
-    logger.info(f"Headers: {request.headers}")
+#@app.post("/slack/events/{token_key}")
+async def handle_slack_events(token_key: str, request: Request, payload: dict = Depends(verify_slack_request)):
     # Handle URL verification challenge
     if payload.get("type") == "url_verification":
         return {"challenge": payload.get("challenge")}
-    
+
+    return await accept_slack_event(
+        token_key,
+        payload,
+        request.headers.get('X-Slack-Retry-Num'),
+        request.headers.get('X-Slack-Retry-Reason'),
+        request.headers
+    )
+
+#@app.post("/slack/events")
+async def handle_shared_slack_events(request: Request):
+    """
+    One events URL for all the bots of the deployment. The bot is found from the payload's api_app_id
+    (SLACK_APP_TOKEN_KEYS) or else by the signing secret the request was signed with, then it's handled like on the bot's own route.
+    """
+    body = await request.body()
+    # Parsed once, only api_app_id is read before the signature is checked
+    payload = parse_slack_payload(body)
+    api_app_id = payload.get('api_app_id')
+
+    token_key = APP_TOKEN_KEYS.get(api_app_id)
+    if token_key is None:
+        # Forged or stale requests must not load credentials from the DB: the cheap header checks run first, and only
+        # the signing secrets of bots already loaded are tried. One past its TTL is only reloaded once its old secret
+        # matched, and check_slack_signature below verifies the request again with the reloaded secret
+        timestamp, signature = check_signature_headers("/slack/events", request)
+        for key, bot in bot_registry.loaded_entries():
+            if bot.signature_verifier.is_valid(body=body, timestamp=timestamp, signature=signature):
+                token_key = key
+                break
+    if token_key is None:
+        logger.info("No bot found for app %s", api_app_id)
+        raise HTTPException(status_code=404, detail="Bot not found")
+
+    await check_slack_signature(token_key, request, body)
+    return await handle_slack_events(token_key, request, payload)
+
+async def accept_slack_event(token_key: str, payload: dict, retry_num=None, retry_reason=None, headers=None):
+    """
+    Dedups the event and hands it to the worker pool (or processes it inline), for the HTTP routes and Socket Mode
+    """
+    # Every log line of this event, also from the worker task that processes it, carries its event id
+    bind_event(token_key, payload.get('event_id'))
+    if headers is not None:
+        log_payload(logger, "headers", headers)
+    log_payload(logger, "payload", payload)
     event = payload.get('event', {})
     
     # Skip certain event subtypes, since I was using a typing message to show while the bot is processing request, we need to delete it after the bot has responded
     if event.get('subtype') in ['message_changed', 'message_deleted']:
-        logger.info(f"Skipping message with subtype: {event.get('subtype')}")
+        logger.info("Skipping message with subtype: %s", event.get('subtype'))
         return {"ok": True}
 
+    # Prevent duplicate processing, slack sends the same event_id again when it retries
+    event_key = (token_key, payload.get('event_id') or event.get('event_ts'))
+    if not await processed_events.add(event_key):
+        logger.info("Event already accepted: %s, retry: %s (%s)", event_key, retry_num, retry_reason)
+        metrics.observe_event(token_key, "deduped", 0.0)
+        # Tell slack to stop retrying, we already have this event
+        return JSONResponse(content={"ok": True}, headers={"X-Slack-No-Retry": "1"})
+
+    # Journal the event before acking it, so it survives a restart while the bot is still answering. Deliveries that
+    # routing drops right away (most channel copies are for another bot) are not worth a commit before the ack
+    journaled = False
+    if event_journal is not None and await routed_to_bot(token_key, event):
+        try:
+            await event_journal.append(token_key, event_key[1], payload)
+            journaled = True
+        except Exception as e:
+            logger.error("Event %s is processed without the journal: %s", event_key, e)
+    if journaled:
+        job = functools.partial(run_journaled_event, token_key, event_key[1], event, payload.get('team_id'))
+    else:
+        job = functools.partial(run_slack_event, token_key, event, payload.get('team_id'))
+
+    if DISPATCH_MODE == "inline":
+        return await job()
+
+    # Ack right away and let the worker pool do the slow part, slack retries anything not acked within 3 seconds
+    if not event_worker_pool.submit(token_key, job):
+        # Pool is full, a 503 makes slack retry the event later instead of us dropping it
+        await processed_events.delete(event_key)
+        if journaled:
+            await event_journal.discard(token_key, event_key[1])
+        return JSONResponse(status_code=503, content={"error": "Too many events in progress"})
+    return {"ok": True}
+
+async def routed_to_bot(token_key: str, event: dict) -> bool:
+    # False when route_event already knows the bot won't answer, from the cached bot user id and thread index only
+    is_dm = event.get('channel_type') == "im"
+    thread_owner = None if is_dm else await thread_index.peek(event.get('channel'), event.get('thread_ts') or event.get('ts'))
+    route, _ = route_event(event, bot_registry.cached_bot_user_id(token_key), thread_owner)
+    return route != IGNORE
+
+async def run_journaled_event(token_key: str, event_id: str, event: dict, team_id: str = None, progress: EventProgress = None):
+    # Marks the event done in the journal when it's finished, also when it failed, so a bad event isn't retried forever
+    if progress is None:
+        progress = EventProgress(event_journal, token_key, event_id)
+    if progress.get("reply_ts"):
+        # Replay of an event that was answered before its replica stopped, only marking it done was lost
+        logger.info("Event %s was already answered (%s), not posting again", event_id, progress.get("reply_ts"))
+        if event_journal is not None:
+            await event_journal.mark_done(token_key, event_id)
+        return {"ok": True}
+    finished = True
+    try:
+        return await run_slack_event(token_key, event, team_id, progress)
+    except asyncio.CancelledError:
+        # Shutting down before it finished, it stays in the journal and is claimed again
+        finished = False
+        raise
+    finally:
+        if finished and event_journal is not None:
+            await event_journal.mark_done(token_key, event_id)
+
+async def replay_event_journal():
+    """
+    Processes the events that were accepted but never finished because their replica stopped or crashed, this one before
+    a restart or another one that was scaled in: their lease ran out and they are claimed here. Runs for the life of the
+    process. Claimed events are added to the dedup store first, so slack's own retries of them are dropped.
+    """
+    while True:
+        try:
+            claimed = await event_journal.claim_expired()
+        except Exception as e:
+            logger.error("Error claiming events from the journal: %r", e)
+            claimed = []
+        for token_key, event_id, payload, attempts, progress in claimed:
+            bind_event(token_key, event_id)
+            if attempts > JOURNAL_MAX_ATTEMPTS:
+                logger.error("Giving up on event %s for %s after %s attempts", event_id, token_key, attempts - 1)
+                await event_journal.mark_done(token_key, event_id)
+                continue
+            await processed_events.add((token_key, event_id))
+            job = functools.partial(
+                run_journaled_event, token_key, event_id, payload.get('event', {}), payload.get('team_id'),
+                EventProgress(event_journal, token_key, event_id, progress)
+            )
+            # Replays go through the same worker pool, wait for room instead of dropping them
+            while not event_worker_pool.submit(token_key, job):
+                await asyncio.sleep(0.5)
+            logger.info("Replaying event %s for %s from the journal, attempt %s", event_id, token_key, attempts)
+        await asyncio.sleep(JOURNAL_CLAIM_INTERVAL)
+
+async def start_journal_replay():
+    # In the background, so a long backlog doesn't hold up the startup
+    global journal_replay
+    if event_journal is None:
+        return
+    await event_journal.start()
+    journal_replay = asyncio.ensure_future(replay_event_journal())
+
+async def close_event_journal():
+    if journal_replay is not None:
+        journal_replay.cancel()
+    if event_journal is not None:
+        await event_journal.close()
+
+async def run_slack_event(token_key: str, event: dict, team_id: str = None, progress: EventProgress = None):
+    # Times the whole event and records its outcome: replied, skipped or error
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await process_slack_event(token_key, event, team_id, progress)
+        outcome = "replied" if result.get("replied") else "error" if result.get("error") else "skipped"
+        return result
+    finally:
+        metrics.observe_event(token_key, outcome, time.perf_counter() - started)
+
+async def run_in_bot_thread(function, *args, **kwargs):
+    # Like asyncio.to_thread on the bot pool, the thread keeps the event's log context
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        bot_executor, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+async def post_placeholder(client, progress: EventProgress, **kwargs):
+    # The "thinking" message, a replayed event reuses the one it posted before its replica stopped
+    placeholder_ts = progress.get("placeholder_ts")
+    if placeholder_ts:
+        return {"ts": placeholder_ts}
+    response = await client.chat_postMessage(**kwargs)
+    await progress.save(placeholder_ts=response['ts'])
+    return response
+
+async def coordinated_owner(token_key: str, event: dict, channel_id: str, thread_ts: str, mentioned_users):
+    """
+    Returns who answers this channel message (see owner_of), computed by the first bot that gets it and stored per
+    (channel, ts) so the copies slack delivers to the other bots reuse it instead of deciding again
+    """
+    key = (channel_id, event.get('ts'))
+    decision = await route_decisions.get(key)
+    if decision is not None:
+        return decision['owner']
+
+    thread_owner = await thread_index.peek(channel_id, thread_ts)
+    if thread_owner is None and event.get('thread_ts') not in (None, event.get('ts')):
+        bot = await bot_registry.get(token_key)
+        if bot is None:
+            return None
+        with metrics.stage("thread_lookup", token_key):
+            thread_owner = await thread_index.get(bot.client, channel_id, thread_ts)
+    owner = owner_of(event, thread_owner, mentioned_users)
+    if owner is None:
+        return None
+    if not await route_decisions.add(key, {"owner": owner}):
+        # Another bot decided at the same time, go with its decision
+        decision = await route_decisions.get(key)
+        if decision is not None:
+            return decision['owner']
+    return owner
+
+async def coordinated_warning(event: dict, channel_id: str, first_bot: str):
+    """
+    Returns which bot posts the "mention only one bot" warning for a channel message that mentions several bots: the
+    first one mentioned. Stored like the other routing decisions, so the other mentioned bots don't warn a second time
+    """
+    key = (channel_id, event.get('ts'))
+    if not await route_decisions.add(key, {"owner": first_bot, "warn": True}):
+        decision = await route_decisions.get(key)
+        if decision is not None:
+            return decision['owner']
+    return first_bot
+
+async def process_slack_event(token_key: str, event: dict, team_id: str = None, progress: EventProgress = None):
+    """
+    Does the actual work for an event that was already verified: routing, file uploads, calling the bot and posting the reply.
+    What was posted is saved to progress, so a replay of the event doesn't post it again.
+    """
+    if progress is None:
+        progress = EventProgress()
     # Get message details
     channel_id = event.get('channel')
     user_id = event.get('user')
     text = event.get('text', '')
+    team_id = team_id or event.get('team')
     thread_ts = event.get('thread_ts')
     if not thread_ts:
         thread_ts = event.get('ts')
-    event_ts = event.get('event_ts')
     
     # Get files from the event if present
     files = event.get('files', [])
     input_files = []
+    is_dm = event.get('channel_type') == "im"
+
+    # Every bot in the channel sees every message, keep the shared thread ownership index up to date from it
+    mentioned_users = extract_mentions(text)
+    if not is_dm:
+        await thread_index.record_message(channel_id, event, mentioned_users)
+
+    # All bots share one decision per message on which of them answers, the first bot to get the message makes it
+    owner = None
+    if COORDINATED_ROUTING:
+        owner = await coordinated_owner(token_key, event, channel_id, thread_ts, mentioned_users)
+        cached_bot_id = bot_registry.cached_bot_user_id(token_key)
+        if owner == "" or (owner and cached_bot_id and owner != cached_bot_id):
+            logger.info("Skipping event: answered by %s", owner or "no bot")
+            return {"ok": True}
+
+    # Most channel messages are for another bot, drop them from what we already know before any DB or slack call
+    route, reason = route_event(
+        event,
+        bot_registry.cached_bot_user_id(token_key),
+        None if is_dm else await thread_index.peek(channel_id, thread_ts),
+        mentioned_users
+    )
+    if route == IGNORE:
+        logger.info("Skipping event: %s", reason)
+        return {"ok": True}
 
-    # Get or create client for this bot
-    client, signature_verifier, bot_creds = get_or_create_client(token_key)
-    logger.info(f"Client: {client}")
-    logger.info(f"Signature verifier: {signature_verifier}")
-    logger.info(f"Bot credentials: {bot_creds}")
-    if not client:
-        logger.info(f"Bot {token_key} not found in configuration")
+    bot = await bot_registry.get(token_key)
+    if not bot:
+        logger.info("Bot %s not found in configuration", token_key)
         return {"error": "Bot not found"}
+    client, bot_creds = bot.client, bot.credentials
     
     # Initialize input_files_list outside the files block
     input_files_list = []  # Initialize empty list for file paths
-    if event_ts in processed_messages:
-            logger.info(f"Message already processed: {event_ts}")
-            return {"ok": True}
     
-    is_dm = event.get('channel_type') == "im"
-    url = "https://slack.com/api/auth.test"
-    headers = {
-        "Authorization": f"Bearer {bot_creds['slack_token']}"
-    }
+    try:
+        with metrics.stage("auth_test", token_key):
+            BOT_ID = await bot_registry.get_bot_user_id(token_key)
+    except SlackApiError as e:
+        # Token was probably rotated or revoked, reload the credentials once and try again
+        logger.error("auth.test failed for %s: %s, refreshing bot client", token_key, e)
+        bot_registry.invalidate(token_key)
+        bot = await bot_registry.get(token_key)
+        if not bot:
+            return {"error": "Bot not found"}
+        client, bot_creds = bot.client, bot.credentials
+        BOT_ID = await bot_registry.get_bot_user_id(token_key)
+    logger.debug("BOT_ID: %s", BOT_ID)
+    if owner and owner != BOT_ID:
+        logger.info("Skipping event: answered by %s", owner)
+        return {"ok": True}
 
-    response = requests.get(url, headers=headers)
-    logger.info(f"response: {response.json()}")
-    BOT_ID = response.json()['user_id']
-    logger.info(f"BOT_ID: {BOT_ID}")
     # Process uploaded files if any
     if files:
         # First check if this bot should process the message
@@ -136,137 +626,108 @@ async def handle_slack_events(token_key: str, request: Request):
                     logger.info("Files uploaded but bot not mentioned, skipping")
                     return {"ok": True}
             else:  # Thread reply
-                # Get the original message to check if the bot was mentioned in the original message
-                thread_messages = client.conversations_replies(
-                    channel=channel_id,
-                    ts=thread_ts,
-                    limit=1
-                )
-                original_message = thread_messages['messages'][0]
-                if f"<@{BOT_ID}>" not in original_message.get('text', ''):
+                # Check if the bot was mentioned in the original message, from the thread index
+                with metrics.stage("thread_lookup", token_key):
+                    thread_owner = await thread_index.get(client, channel_id, thread_ts)
+                if BOT_ID not in thread_owner['root_mentions']:
                     logger.info("Files uploaded in thread but bot not mentioned in original message, skipping")
                     return {"ok": True}
 
-        # Check if message was already processed before doing any work
-        if event_ts in processed_messages:
-            logger.info(f"Message already processed: {event_ts}")
-            return {"ok": True}
-        
         # we need to process the uploded files for the bot to answer according to the uploaded file
-        logger.info(f"Processing {len(files)} files")
+        logger.info("Processing %s files", len(files))
         is_dm = event.get('channel_type') == 'im'
         loading_message = bot_creds['loading_message']
-        thinking_response = client.chat_postMessage(
+        thinking_response = await post_placeholder(
+                client,
+                progress,
                 channel=channel_id, 
                 thread_ts=None if is_dm else thread_ts,
                 text=loading_message,
                 mrkdwn=True
         )
-        timestamp = str(int(datetime.now().timestamp() * 1000))
-        temp_files = []  # List to store temporary file paths
-        file_names = []  # List to store file names
-        
-        # First, download all files
+        # Files we already uploaded for this bot (same slack file_id, e.g. a PDF re-shared in another thread) are not
+        # downloaded or uploaded again, the file_path the upload api returned last time is reused
+        new_files = []
         for file in files:
+            cached_path = await uploaded_files.get((token_key, file.get('id')))
+            if cached_path is None:
+                new_files.append(file)
+                continue
+            logger.info("Reusing uploaded file %s: %s", file.get('name'), cached_path)
+            input_files.append({
+                "file_name": file.get('name'),
+                "file_type": file.get('filetype'),
+                "file_id": file.get('id'),
+                "file_path": cached_path
+            })
+            if cached_path not in input_files_list:
+                input_files_list.append(cached_path)
+
+        # Stream every new file from slack straight into one upload to our bot's file upload api, no temp files
+        if not new_files:
+            logger.info("All files were uploaded before, skipping the upload")
+        else:
             try:
-                # Get file info
-                file_id = file.get('id')
-                file_name = file.get('name')
-                file_names.append(file_name)
-                file_type = file.get('filetype')
-                file_url = file.get('url_private_download')
-                
-                # Download file using bot token for authentication, provided by the slack api
-                headers = {'Authorization': f'Bearer {bot_creds["slack_token"]}'}
-                file_response = requests.get(file_url, headers=headers)
-                
-                if file_response.status_code == 200:
-                    # Create a temporary file with a safe name
-                    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                        # Write the content to the temp file
-                        temp_file.write(file_response.content)
-                        temp_file.flush()
-                        temp_files.append((temp_file.name, file_name))
-                        logger.info(f"Successfully downloaded file: {file_name}")
-                        
-            except Exception as e:
-                logger.error(f"Error downloading file {file_name}: {e}")
-                
-        # Now upload all files together to our bot's file upload api
-        try:
-            # Prepare data for our bot's file upload api
-            api_data = {
-                "data": json.dumps({
-                    "_____": "_____"
-                })
-            }
+                # Prepare data for our bot's file upload api
+                api_data = {
+                    "data": json.dumps({
+                        "_____": "_____"
+                    })
+                }
             
-            # Prepare files data for the API call
-            files_data = {}
-            file_handles = []  # Keep track of open file handles
+                # Upload to  bot's file upload API
+                api_headers = {
+                    "_____": "_____"
+                }
             
-            # Open all files at once
-            for temp_path, file_name in temp_files:
-                file_handle = open(temp_path, 'rb')
-                file_handles.append(file_handle)
-                files_data[file_name] = (
-                    file_name, 
-                    file_handle, 
-                    'application/pdf' if file_name.lower().endswith('.pdf') else 'application/octet-stream'
+                file_upload = StreamingFileUpload(
+                    get_http_client(),
+                    bot_creds['slack_token'],
+                    max_file_bytes=MAX_FILE_BYTES,
+                    file_timeout=FILE_TIMEOUT
                 )
+                with metrics.stage("file_upload", token_key):
+                    api_response = await file_upload.upload(
+                        os.getenv('BOT_FILE_UPLOAD_URL'),
+                        new_files,
+                        form_data=api_data,
+                        headers=api_headers
+                    )
+                logger.info("Uploaded files: %s, skipped: %s", file_upload.uploaded_files, file_upload.skipped_files)
             
-            logger.info(f"files_data: {files_data}")
-            
-            # Upload to  bot's file upload API
-            api_headers = {
-                "_____": "_____"
-            }
-            
-            api_response = requests.post(
-                os.getenv('BOT_FILE_UPLOAD_URL'),
-                headers=api_headers,
-                data=api_data,
-                files=files_data
-            )
-            
-            # Close all file handles
-            for handle in file_handles:
-                handle.close()
-            
-            if api_response.status_code == 200:
-                logger.info(f"api_response: {api_response.json()}")
-                api_data = api_response.json()
+                if api_response.status_code == 200:
+                    api_data = api_response.json()
+                    log_payload(logger, "api_response", api_data)
                 
-                # Store file information
-                for file in files:
-                    file_data = {           
-                        "file_name": file.get('name'),
-                        "file_type": file.get('filetype'),
-                        "file_id": file.get('id'),
-                        "file_path": api_data.get('file_path'),
-                        "api_response": api_data
-                    }
-                    input_files.append(file_data)
+                    # Store file information
+                    for file in new_files:
+                        file_data = {           
+                            "file_name": file.get('name'),
+                            "file_type": file.get('filetype'),
+                            "file_id": file.get('id'),
+                            "file_path": api_data.get('file_path'),
+                            "api_response": api_data
+                        }
+                        input_files.append(file_data)
+                    # The upload api returns one file_path for the whole upload, it only stands for a single file when
+                    # the upload had exactly one, otherwise a re-shared file would bring the other files of this upload with it
+                    if api_data.get('file_path') and len(file_upload.uploaded_files) == 1:
+                        for file in new_files:
+                            if file.get('name') in file_upload.uploaded_files:
+                                await uploaded_files.set((token_key, file.get('id')), api_data.get('file_path'))
+                                break
                 
-                # Add the file path to input_files_list
-                if api_data.get('file_path'):
-                    input_files_list.append(api_data.get('file_path'))
-                logger.info(f"Successfully processed and uploaded all files")
-            else:
-                logger.error(f"Error uploading to bot's file upload API: {api_response.text}")
+                    # Add the file path to input_files_list
+                    if api_data.get('file_path') and api_data.get('file_path') not in input_files_list:
+                        input_files_list.append(api_data.get('file_path'))
+                    logger.info("Successfully processed and uploaded all files")
+                else:
+                    logger.error("Error uploading to bot's file upload API: %s", api_response.text)
                 
-        except Exception as e:
-            logger.error(f"Error uploading files to bot's file upload API: {e}")
-            
-        finally:
-            # Clean up all temporary files
-            for temp_path, _ in temp_files:
-                try:
-                    os.remove(temp_path)
-                except Exception as e:
-                    logger.error(f"Error removing temporary file {temp_path}: {e}")
-
-    logger.info(f"thread_ts: {thread_ts}")
+            except Exception as e:
+                logger.error("Error uploading files to bot's file upload API: %s", e)
+
+    logger.debug("thread_ts: %s", thread_ts)
     is_thread_reply = thread_ts is not None
     is_dm = event.get('channel_type') == "im"
 
@@ -277,47 +738,33 @@ async def handle_slack_events(token_key: str, request: Request):
         logger.info("Skipping bot's own message")
         return {"ok": True}
 
-    # Verify the request signature
-    timestamp = request.headers.get('X-Slack-Request-Timestamp', '')
-    signature = request.headers.get('X-Slack-Signature', '')
-    
-    # Verify request is not too old
-    if abs(time.time() - int(timestamp)) > 60 * 5:
-        return {"error": "Request too old"}
-        
-    # Verify the request signature
-    if not signature_verifier.is_valid(
-        body=body,
-        timestamp=timestamp,
-        signature=signature
-    ):
-        logger.error("Invalid request signature")
-        return {"error": "Invalid request signature"}
-
-    # Check for multiple bot mentions
-    mentioned_users = [mention.split('>')[0] for mention in text.split('<@') if mention.strip()]
+    # Check for multiple bot mentions, is_bot comes from the user profile cache
     bot_count = 0
-    
-    for user_id in mentioned_users:
-        if user_id:  # Skip empty strings
-            try:
-                # Get user info from Slack
-                user_info = client.users_info(user=user_id)
-                if user_info['user']['is_bot']:
-                    bot_count += 1
-                    logger.info(f"bot_count: {bot_count}")
-            except SlackApiError as e:
-                logger.error(f"Error getting user info: {e}")
-                continue
+    if len(mentioned_users) > 1:
+        if team_id and WARM_USER_CACHE:
+            user_profiles.warm_in_background(client, team_id)
+        with metrics.stage("user_lookup", token_key):
+            bot_count = await user_profiles.count_bots(client, team_id, mentioned_users)
+        logger.debug("bot_count: %s", bot_count)
 
     if text and bot_count > 1:
+            if COORDINATED_ROUTING and not is_dm:
+                # Every mentioned bot gets this message, only the first one mentioned posts the warning.
+                # The profiles are cached by count_bots
+                profiles = [await user_profiles.is_bot(client, team_id, user) for user in mentioned_users]
+                first_bot = next(user for user, is_bot in zip(mentioned_users, profiles) if is_bot)
+                warning_bot = await coordinated_warning(event, channel_id, first_bot)
+                if warning_bot != BOT_ID:
+                    logger.info("Skipping: Multiple bot mentions, %s posts the warning", warning_bot)
+                    return {"ok": True}
             logger.info("Skipping: Multiple bot mentions")
-            client.chat_postMessage(
+            warning_response = await client.chat_postMessage(
                 channel=channel_id,
                 thread_ts=None if is_dm else thread_ts,
                 text="Please mention only one bot at a time. Please start a new thread with a single bot mention.",
                 mrkdwn=True
             )
+            await progress.save(reply_ts=warning_response['ts'])
             return {"ok": True}
 
     # Check if message should be processed
@@ -329,74 +776,46 @@ async def handle_slack_events(token_key: str, request: Request):
     # Check thread involvement for thread replies
     if is_thread_reply and not is_dm:
         try:
-            # Get the thread messages
-            thread_messages = client.conversations_replies(
-                channel=channel_id,
-                ts=thread_ts
-            )
-
             # Check if this message mentions another user/bot
-            mentions = re.findall(r'<@([A-Z0-9]+)>', text)
+            mentions = mentioned_users
             if mentions:
                 # If message mentions someone and it's not just this bot, skip processing
                 if len(mentions) > 1 or (len(mentions) == 1 and mentions[0] != BOT_ID):
                     logger.info("Message mentions another user/bot in thread, skipping")
                     return {"ok": True}
-            # Check if this bot has responded in the thread
-            bot_involved = False
-            if thread_messages.get('messages'):
-                # First check if the original message mentioned this bot
-                original_message = thread_messages['messages'][0]
-                if f"<@{BOT_ID}>" in original_message.get('text', ''):
-                    bot_involved = True
-                else:
-                    # If not mentioned in original message, only respond if this specific bot
-                    # was the last bot to respond in the thread
-                    last_bot_message = None
-                    for message in thread_messages['messages']:
-                        if message.get('bot_id') and message.get('user') == BOT_ID:
-                            last_bot_message = message
-                        # If we find a different bot's message after our last message,
-                        # we should not respond
-                        elif message.get('bot_id') and last_bot_message:
-                            bot_involved = False
-                            break
-                        
-                    if last_bot_message:
-                        bot_involved = True
+
+            # Who owns the thread comes from the thread index, slack is only asked if we haven't seen the thread yet
+            with metrics.stage("thread_lookup", token_key):
+                thread_owner = await thread_index.get(client, channel_id, thread_ts)
+            # The original message mentioned this bot, or (if not) this specific bot was the last bot to respond in the thread
+            bot_involved = BOT_ID in thread_owner['root_mentions'] or thread_owner['last_bot'] == BOT_ID
             
             if not bot_involved:
                 logger.info("This bot was not involved in the thread or another bot responded after")
                 return {"ok": True}
 
         except Exception as e:
-            logger.error(f"Error checking thread messages: {e}")
+            logger.error("Error checking thread messages: %s", e)
             return {"ok": True}
 
     # Final check if bot should respond
     if f"<@{BOT_ID}>" in text or (thread_ts is not None) or event.get('channel_type') == "im":
-        logger.info(f"Message meets conditions for reply")
+        logger.info("Message meets conditions for reply")
 
-        # Prevent duplicate processing
-        if event_ts in processed_messages:
-            logger.info(f"Message already processed: {event_ts}")
-            return {"ok": True}
-        
-        processed_messages.add(event_ts)
-        
-        # Remove duplicate check here since we do it at the start
+        # Duplicate deliveries were already dropped in handle_slack_events
         user_message = text.replace(f"<@{BOT_ID}>", "").strip()
         if not user_message:
             # Get welcome message from bot credentials, we will use this to show the user that the bot is ready to answer questions
             welcome_message = "________"
-            client.chat_postMessage(
+            welcome_response = await client.chat_postMessage(
                 channel=channel_id,
                 thread_ts=None if event.get('channel_type') == 'im' else thread_ts,
                 text=welcome_message,
                 mrkdwn=True
             )
-            logger.info(f"Welcome message sent: {welcome_message}")
-            return {"ok": True}
+            await progress.save(reply_ts=welcome_response['ts'])
+            logger.info("Welcome message sent: %s", welcome_message)
+            return {"ok": True, "replied": True}
             
         try:
             # For maintaining memory we used to set same uuid for messages in same thread. we will be sending this to our bot's payload
@@ -407,98 +826,115 @@ async def handle_slack_events(token_key: str, request: Request):
             if not input_files_list:  # Only show loading message if no files were processed, this is to avoid showing the loading message if the user has uploaded files, since for file upload we have shown the loading message in the file upload route
                 is_dm = event.get('channel_type') == 'im'
                 loading_message = "________"
-                thinking_response = client.chat_postMessage(
+                thinking_response = await post_placeholder(
+                        client,
+                        progress,
                         channel=channel_id, 
                         thread_ts=None if is_dm else thread_ts,
                         text=loading_message,
                         mrkdwn=True
                 )
+            # Files uploaded earlier in this thread are sent again, so follow-up questions can refer to them without a new upload
+            thread_context = await thread_contexts.get(token_key, channel_id, thread_uuid)
+            thread_history = list(thread_context["turns"])
+            earlier_file_paths = [path for path in thread_context["file_paths"] if path not in input_files_list]
+            await thread_contexts.add_file_paths(token_key, channel_id, thread_uuid, input_files_list)
+            input_files_list = earlier_file_paths + input_files_list
+
             # Use the collected file paths list - remove any whitespace
             input_files_string = ",".join(path.strip() for path in input_files_list) if input_files_list else ""
-            logger.info(f"input_files_string: {input_files_string}")
+            log_payload(logger, "input_files_string", input_files_string)
             slack_payload = {
                 "_____": "_____"
             }
+            # Earlier questions and answers of the thread, so the bot doesn't have to rebuild its context
+            slack_payload["thread_history"] = thread_history
             # we will use this payload to send the user message to the bot
-            logger.info(f"slack_payload: {slack_payload}")
+            log_payload(logger, "slack_payload", slack_payload)
             #With this payload we will call the bot
-            response = execute_bot(slack_payload)
-
-            if response.status_code == 200:
+            # execute_bot is synchronous, run it in a thread of the bot pool so it doesn't block the other events
+            with metrics.stage("execute_bot", token_key):
+                if STREAM_RESPONSES:
+                    # In streaming mode execute_bot has to accept stream=True and return the response without reading its body
+                    response = await run_in_bot_thread(execute_bot, slack_payload, stream=True)
+                else:
+                    response = await run_in_bot_thread(execute_bot, slack_payload)
+
+            if response.status_code == 200 and STREAM_RESPONSES:
+                # Edit the "thinking" message in place while the answer is generated instead of deleting and reposting it
+                streaming_reply = StreamingReply(
+                    client,
+                    channel_id,
+                    None if is_dm else thread_ts,
+                    thinking_response['ts'],
+                    update_interval=STREAM_UPDATE_INTERVAL
+                )
+                with metrics.stage("stream_reply", token_key):
+                    async for chunk in iter_bot_response(response, bot_executor):
+                        await streaming_reply.append(chunk)
+                    await streaming_reply.finish(get_http_client(), image_validator, image_deadline=IMAGE_CHECK_DEADLINE)
+                await progress.save(reply_ts=streaming_reply.message_ts[-1])
+                if not is_dm:
+                    await thread_index.record_bot_reply(channel_id, thread_ts, BOT_ID)
+                await thread_contexts.add_turns(
+                    token_key, channel_id, thread_uuid, [("user", user_message), ("assistant", streaming_reply.text)]
+                )
+                return {"ok": True, "replied": True}
+            elif response.status_code == 200:
                 response_data = response.json()
-                logger.info(f"response_data: {response_data}")
+                log_payload(logger, "response_data", response_data)
 
                 if 'response' in response_data:
                     message = response_data['response']
-                    # First remove any double asterisks inside headers
-                    message = re.sub(r'### \*\*(.*?)\*\*', r'### \1', message)
-                    # Then handle all remaining bold patterns
-                    message = re.sub(r'\*\*?|\*\*?', '*', message)
-                    # Finally handle headers by replacing with bold
-                    message = re.sub(r'### (.*?)(\n|$)', r'*\1*\2', message)
-                    logger.info(f"message: {message}")
-                    # Slack-friendly formatting
-
-                    # Regex to match Markdown image syntax ![alt_text](image_url), supports multiple images
-                    image_pattern = re.compile(r'!\[(.*?)\]\((.*?)\)')
-                    logger.info(f"image_pattern: {image_pattern}")
-                    blocks = []
-                    last_index = 0
-
-                    # Process text and images in the correct order
-                    for match in image_pattern.finditer(message):
-                        alt_text, image_url = match.groups()
-                        text_before = message[last_index:match.start()].strip()
-
-                        # Add text block before the image (if there's any)
-                        if text_before:
-                            blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": text_before}})
-
-                        # Validate and add image block
-                        try:
-                            response = requests.head(image_url, timeout=5)
-                            if response.status_code == 200:
-                                blocks.append({"type": "image", "image_url": image_url, "alt_text": alt_text})
-                        except Exception:
-                            logger.warning(f"Skipping invalid image URL: {image_url}")
-
-                        last_index = match.end()
-
-                    # Add remaining text after the last image
-                    remaining_text = message[last_index:].strip()
-                    if remaining_text:
-                        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": remaining_text}})
-
                 else:
                     message = response_data.get('status', 'No response available')
+                # Slack-friendly formatting, ordered text and image blocks split into as many messages as slack's limits need
+                with metrics.stage("format_response", token_key):
+                    reply_messages = await build_messages(message, get_http_client(), image_validator, deadline=IMAGE_CHECK_DEADLINE)
+                logger.info("Bot response formatted into %s message(s)", len(reply_messages))
 
                 # Delete the "thinking" message in DMs
                 if thinking_response.get('ts'):
                     try:
-                        client.chat_delete(channel=channel_id, ts=thinking_response['ts'])
+                        await client.chat_delete(channel=channel_id, ts=thinking_response['ts'])
                     except Exception as e:
-                        logger.error(f"Error deleting thinking message: {e}")
+                        logger.error("Error deleting thinking message: %s", e)
+                    # A replay after this point posts a new one instead of reusing the deleted message
+                    await progress.save(placeholder_ts=None)
 
                 # Send Slack message with ordered text and image blocks, we will use this to send the bot response to the user
-                client.chat_postMessage(
-                    channel=channel_id, 
-                    thread_ts=None if is_dm else thread_ts,
-                    text=message,  # Fallback text
-                    mrkdwn=True,
-                    unfurl_links=True,
-                    unfurl_media=True,
-                    blocks=blocks
-                )
+                with metrics.stage("post_reply", token_key):
+                    for reply_message in reply_messages:
+                        reply_response = await client.chat_postMessage(
+                            channel=channel_id, 
+                            thread_ts=None if is_dm else thread_ts,
+                            text=reply_message['text'],  # Fallback text
+                            mrkdwn=True,
+                            unfurl_links=True,
+                            unfurl_media=True,
+                            blocks=reply_message['blocks']
+                        )
+                await progress.save(reply_ts=reply_response['ts'])
+                if not is_dm:
+                    await thread_index.record_bot_reply(channel_id, thread_ts, BOT_ID)
+                await thread_contexts.add_turns(token_key, channel_id, thread_uuid, [("user", user_message), ("assistant", message)])
+                return {"ok": True, "replied": True}
             else:
+                if STREAM_RESPONSES:
+                    # Nobody reads the body of a streamed error response, close it so its connection is not leaked
+                    response.close()
                 unanswerable_message = "________"
-                logger.error(f"Error calling HTTP trigger: {response.status_code}")
-                client.chat_postMessage(
+                logger.error("Error calling HTTP trigger: %s", response.status_code)
+                unanswerable_response = await client.chat_postMessage(
                     channel=channel_id, 
                     thread_ts=None if is_dm else thread_ts,
                     text=unanswerable_message,
                     mrkdwn=True
                 )
+                await progress.save(reply_ts=unanswerable_response['ts'])
+                return {"ok": True, "error": "bot_error"}
         
         except Exception as e:
-            logger.error(f"Error calling HTTP trigger: {e}")
+            logger.error("Error calling HTTP trigger: %s", e)
+            return {"ok": True, "error": "exception"}
     return {"ok": True}
\ No newline at end of file
@@ -0,0 +1,456 @@
+"""
+Load test for the slack event handler, everything runs in one process without any network access:
+
+* a fake Slack Web API (auth.test, users.info/list, conversations.replies, chat.postMessage/update/delete, file
+  downloads and image links) with configurable latency and injected 429s
+* a fake bot backend: execute_bot and the BOT_FILE_UPLOAD_URL upload API
+* a generator of signed events for N bots, mixing DMs, mentions, thread replies, files, multi bot mentions and
+  channel chatter; channel messages are delivered to every bot like slack does
+
+Run it from the package that contains slackApp, e.g.
+
+    python -m <package>.slackBenchmark --bots 4 --messages 500 --concurrency 50
+
+It prints p50/p99 latency (ack and full processing), events per second and slack API calls per message.
+--json prints the report as JSON, and --max-p99-ms / --max-calls-per-message / --min-events-per-second make it exit
+with 1 when a run is worse, so CI can catch regressions.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+
+# Share of each kind of message, see EventGenerator
+DEFAULT_MIX = "dm=0.15,mention=0.25,thread=0.25,cold_thread=0.05,file=0.05,multi=0.05,chatter=0.2"
+HUMAN_USER = "UHUMAN1"
+TEAM_ID = "TBENCH"
+
+
+def bot_user_id(index: int) -> str:
+    return f"UBENCH{index}"
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class FakeSlackApi:
+    """
+    Answers the Web API methods the handler uses, and serves slack file downloads and image links.
+    Every call waits latency seconds (plus up to jitter), and rate_limit_ratio of them get a 429 with Retry-After.
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, rate_limit_ratio: float = 0.0,
+                 retry_after: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.rate_limited = 0
+        # (channel, thread_ts) -> messages, for threads that started before the run (conversations.replies)
+        self.threads = {}
+
+    def add_routes(self, app: web.Application):
+        app.router.add_route('*', '/api/{method}', self.api)
+        app.router.add_get('/files/{file_id}', self.download)
+        app.router.add_route('*', '/images/{image_id}', self.image)
+
+    async def _wait(self):
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+    async def api(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        await self._wait()
+        if self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response(
+                {"ok": False, "error": "ratelimited"}, status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+
+        data = dict(request.query)
+        if request.content_type == 'application/json':
+            data.update(await request.json())
+        else:
+            data.update(await request.post())
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+
+        if method == 'auth.test':
+            # Tokens are xoxb-bench-<index>
+            return web.json_response({"ok": True, "user_id": bot_user_id(token.rsplit('-', 1)[-1]), "team_id": TEAM_ID})
+        if method == 'users.info':
+            user = data.get('user', '')
+            return web.json_response({"ok": True, "user": {"id": user, "is_bot": user.startswith("UBENCH"), "team_id": TEAM_ID}})
+        if method == 'users.list':
+            return web.json_response({"ok": True, "members": [], "response_metadata": {"next_cursor": ""}})
+        if method == 'conversations.replies':
+            messages = self.threads.get((data.get('channel'), data.get('ts')), [])
+            return web.json_response({"ok": True, "messages": messages})
+        if method in ('chat.postMessage', 'chat.update'):
+            return web.json_response({"ok": True, "channel": data.get('channel'), "ts": f"{time.time():.6f}"})
+        return web.json_response({"ok": True})
+
+    async def download(self, request):
+        self.calls['files.download'] += 1
+        await self._wait()
+        return web.Response(body=b"%PDF-1.4 " + os.urandom(32 * 1024), content_type='application/pdf')
+
+    async def image(self, request):
+        self.calls['images.check'] += 1
+        return web.Response(content_type='image/png')
+
+
+class FakeBotBackend:
+    """
+    Stands in for the bot: execute_bot (synchronous, like the real one) and the file upload API
+    """
+
+    def __init__(self, latency: float = 0.2, image_ratio: float = 0.2, base_url: str = "", seed: int = 0):
+        self.latency = latency
+        self.image_ratio = image_ratio
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.uploads = 0
+
+    def add_routes(self, app: web.Application):
+        app.router.add_post('/upload', self.upload)
+
+    def execute_bot(self, payload: dict, stream: bool = False):
+        self.requests += 1
+        time.sleep(self.latency)
+        answer = "**Answer**\n" + "Here is what I found. " * 20
+        if self.random.random() < self.image_ratio:
+            answer += f"\n![chart]({self.base_url}/images/{self.random.randint(1, 20)}.png)\nMore details below."
+        body = {"response": answer}
+        return SimpleNamespace(status_code=200, headers={'Content-Type': 'application/json'}, json=lambda: body)
+
+    async def upload(self, request):
+        self.uploads += 1
+        reader = await request.multipart()
+        async for part in reader:
+            while await part.read_chunk():
+                pass
+        return web.json_response({"file_path": f"/bench/files/{uuid.uuid4().hex}"})
+
+
+class EventGenerator:
+    """
+    Builds signed event_callback requests. A message in a channel is delivered to every bot, a DM only to its bot.
+    """
+
+    def __init__(self, bot_count: int, channel_count: int, mix: dict, files_url: str, slack_api: FakeSlackApi, seed: int = 0):
+        self.bots = [(f"bench_bot_{index}", bot_user_id(index), f"bench-secret-{index}") for index in range(bot_count)]
+        self.channels = [f"CBENCH{index}" for index in range(channel_count)]
+        self.kinds, self.weights = zip(*mix.items())
+        self.files_url = files_url
+        self.slack_api = slack_api
+        self.random = random.Random(seed)
+        self.sequence = 0
+        # (channel, root ts) of the threads started during the run
+        self.threads = []
+
+    def _ts(self) -> str:
+        self.sequence += 1
+        return f"{1700000000 + self.sequence}.{self.sequence:06d}"
+
+    def message(self):
+        """
+        Returns (kind, [(token_key, body, headers), ...]) for the next message
+        """
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        ts = self._ts()
+        bot_index = self.random.randrange(len(self.bots))
+        mention = f"<@{self.bots[bot_index][1]}>"
+        event = {"type": "message", "user": HUMAN_USER, "ts": ts, "event_ts": ts, "team": TEAM_ID}
+
+        if kind == "dm":
+            event.update(channel=f"DBENCH{bot_index}", channel_type="im", text="Can you help me with this?")
+            return kind, [self._delivery(bot_index, event)]
+
+        event.update(channel=self.random.choice(self.channels), channel_type="channel")
+        if kind == "mention":
+            event["text"] = f"{mention} what is the status of the project?"
+            self.threads.append((event["channel"], ts))
+        elif kind == "thread" and self.threads:
+            event["channel"], event["thread_ts"] = self.random.choice(self.threads)
+            event["text"] = "thanks, and what about next week?"
+        elif kind == "cold_thread" or kind == "thread":
+            # A thread that started before the run, only conversations.replies knows who it belongs to
+            root_ts = self._ts()
+            self.slack_api.threads[(event["channel"], root_ts)] = [{"text": f"{mention} earlier question", "ts": root_ts}]
+            event.update(thread_ts=root_ts, text="following up on this")
+        elif kind == "file":
+            file_id = f"FBENCH{self.random.randrange(50)}"
+            event["text"] = f"{mention} summarize this file"
+            event["files"] = [{
+                "id": file_id,
+                "name": f"{file_id}.pdf",
+                "filetype": "pdf",
+                "url_private_download": f"{self.files_url}/{file_id}"
+            }]
+            self.threads.append((event["channel"], ts))
+        elif kind == "multi":
+            other = f"<@{self.bots[(bot_index + 1) % len(self.bots)][1]}>"
+            event["text"] = f"{mention} {other} which of you knows this?"
+        else:
+            event["text"] = "lunch anyone?"
+        return kind, [self._delivery(index, event) for index in range(len(self.bots))]
+
+    def _delivery(self, bot_index: int, event: dict):
+        token_key, _, signing_secret = self.bots[bot_index]
+        payload = {
+            "type": "event_callback",
+            "team_id": TEAM_ID,
+            "api_app_id": f"ABENCH{bot_index}",
+            "event_id": f"Ev{self.sequence:08d}B{bot_index}",
+            "event_time": int(time.time()),
+            "event": dict(event),
+        }
+        body = json.dumps(payload)
+        timestamp = str(int(time.time()))
+        signature = "v0=" + hmac.new(
+            signing_secret.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256
+        ).hexdigest()
+        headers = {
+            "Content-Type": "application/json",
+            "X-Slack-Request-Timestamp": timestamp,
+            "X-Slack-Signature": signature,
+        }
+        return token_key, body, headers
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+async def run_benchmark(options) -> dict:
+    slack_api = FakeSlackApi(
+        latency=options.slack_latency_ms / 1000,
+        jitter=options.slack_jitter_ms / 1000,
+        rate_limit_ratio=options.rate_limit_ratio,
+        retry_after=options.retry_after,
+        seed=options.seed
+    )
+    server = web.Application(client_max_size=100 * 1024 * 1024)
+    slack_api.add_routes(server)
+    bot_backend = FakeBotBackend(latency=options.bot_latency_ms / 1000, seed=options.seed)
+    bot_backend.add_routes(server)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    bot_backend.base_url = base_url
+
+    generator = EventGenerator(
+        options.bots, options.channels, parse_mix(options.mix), f"{base_url}/files", slack_api, seed=options.seed
+    )
+    # slackApp reads its settings when it's imported
+    os.environ['SLACK_API_URL'] = f"{base_url}/api/"
+    os.environ['BOT_FILE_UPLOAD_URL'] = f"{base_url}/upload"
+    os.environ['SLACK_BOT_TOKEN_KEYS'] = ",".join(token_key for token_key, _, _ in generator.bots)
+    os.environ.setdefault('SLACK_LOG_LEVEL', 'INFO' if options.verbose else 'ERROR')
+    slack_app = importlib.import_module(".slackApp", __package__)
+    rate_limits = importlib.import_module(".slackRateLimits", __package__)
+    from fastapi import FastAPI
+    import httpx
+
+    if not options.slack_limits:
+        # Measure our own code, the fake API injects 429s itself
+        for tier in rate_limits.TIER_RATES:
+            rate_limits.TIER_RATES[tier] = 1000000
+        rate_limits.POST_MESSAGE_RATE = 1000000
+        rate_limits.POST_MESSAGE_BURST = 1000000
+
+    credentials = {
+        token_key: {
+            "slack_token": f"xoxb-bench-{index}",
+            "signing_secret": signing_secret,
+            "loading_message": "Thinking...",
+        }
+        for index, (token_key, _, signing_secret) in enumerate(generator.bots)
+    }
+    slack_app.bot_registry.load_credentials = lambda token_key: credentials[token_key]
+    slack_app.execute_bot = bot_backend.execute_bot
+
+    # Full processing time of every delivery, from sending the request until the worker is done with it
+    sent_at = {}
+    processing = []
+    outcomes = Counter()
+    run_slack_event = slack_app.run_slack_event
+
+    async def timed_run_slack_event(token_key, event, team_id=None, progress=None):
+        result = {}
+        try:
+            result = await run_slack_event(token_key, event, team_id, progress)
+            return result
+        finally:
+            started = sent_at.pop((token_key, event.get('ts')), None)
+            if started is not None:
+                processing.append(time.perf_counter() - started)
+            outcomes["replied" if result.get("replied") else "error" if result.get("error") else "skipped"] += 1
+    slack_app.run_slack_event = timed_run_slack_event
+
+    app = slack_app.setup_slack_routes(FastAPI())
+    await slack_app.prewarm_bots()
+    warmup_calls = sum(slack_api.calls.values())
+    slack_api.calls.clear()
+
+    ack = []
+    statuses = Counter()
+    retries = Counter()
+    kinds = Counter()
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def deliver(client, token_key, body, headers, ts):
+        sent_at[(token_key, ts)] = time.perf_counter()
+        for retry_num in range(options.max_retries + 1):
+            if retry_num:
+                # Like slack, events that were not acked with a 2xx are sent again a bit later
+                await asyncio.sleep(options.retry_delay * retry_num)
+                headers = dict(headers, **{"X-Slack-Retry-Num": str(retry_num), "X-Slack-Retry-Reason": "http_error"})
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(f"/slack/events/{token_key}", content=body, headers=headers)
+                ack.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+            if response.status_code < 300:
+                return
+            retries["sent"] += 1
+        retries["dropped"] += 1
+        sent_at.pop((token_key, ts), None)
+
+    transport = httpx.ASGITransport(app=app)
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        pending = []
+        for _ in range(options.messages):
+            kind, deliveries = generator.message()
+            kinds[kind] += 1
+            for token_key, body, headers in deliveries:
+                ts = json.loads(body)["event"]["ts"]
+                pending.append(asyncio.ensure_future(deliver(client, token_key, body, headers, ts)))
+            if options.rate:
+                await asyncio.sleep(1 / options.rate)
+        await asyncio.gather(*pending)
+        await slack_app.event_worker_pool.drain(timeout=options.drain_timeout)
+    elapsed = time.perf_counter() - started
+    await slack_app.close_http_clients()
+    await runner.cleanup()
+
+    deliveries = len(ack) - retries["sent"]
+    slack_calls = sum(count for method, count in slack_api.calls.items() if method != 'images.check')
+    return {
+        "bots": options.bots,
+        "messages": options.messages,
+        "deliveries": deliveries,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(deliveries / elapsed, 1) if elapsed else 0.0,
+        "ack_p50_ms": round(percentile(ack, 0.5) * 1000, 2),
+        "ack_p99_ms": round(percentile(ack, 0.99) * 1000, 2),
+        "processing_p50_ms": round(percentile(processing, 0.5) * 1000, 2),
+        "processing_p99_ms": round(percentile(processing, 0.99) * 1000, 2),
+        "slack_calls": slack_calls,
+        "slack_calls_per_message": round(slack_calls / options.messages, 2) if options.messages else 0.0,
+        "slack_calls_per_delivery": round(slack_calls / deliveries, 2) if deliveries else 0.0,
+        "slack_calls_by_method": dict(slack_api.calls),
+        "slack_429s": slack_api.rate_limited,
+        "warmup_slack_calls": warmup_calls,
+        "bot_requests": bot_backend.requests,
+        "file_uploads": bot_backend.uploads,
+        "http_statuses": {str(status): count for status, count in statuses.items()},
+        "slack_retries": retries["sent"],
+        "dropped_events": retries["dropped"],
+        "outcomes": dict(outcomes),
+        "message_kinds": dict(kinds),
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['messages']} messages, {report['deliveries']} deliveries to {report['bots']} bots in {report['seconds']}s",
+        f"  events/sec:          {report['events_per_second']}",
+        f"  ack latency:         p50 {report['ack_p50_ms']} ms, p99 {report['ack_p99_ms']} ms",
+        f"  processing latency:  p50 {report['processing_p50_ms']} ms, p99 {report['processing_p99_ms']} ms",
+        f"  slack calls:         {report['slack_calls']} ({report['slack_calls_per_message']}/message, "
+        f"{report['slack_calls_per_delivery']}/delivery, {report['slack_429s']} answered 429)",
+        f"  by method:           {json.dumps(report['slack_calls_by_method'], sort_keys=True)}",
+        f"  bot requests:        {report['bot_requests']}, file uploads: {report['file_uploads']}",
+        f"  outcomes:            {json.dumps(report['outcomes'], sort_keys=True)}",
+        f"  http statuses:       {json.dumps(report['http_statuses'], sort_keys=True)}, "
+        f"{report['slack_retries']} retried, {report['dropped_events']} dropped",
+    ]
+    return "\n".join(lines)
+
+
+def check_thresholds(report: dict, options) -> list:
+    failures = []
+    if options.max_p99_ms is not None and report['processing_p99_ms'] > options.max_p99_ms:
+        failures.append(f"processing p99 {report['processing_p99_ms']} ms > {options.max_p99_ms} ms")
+    if options.max_calls_per_message is not None and report['slack_calls_per_message'] > options.max_calls_per_message:
+        failures.append(f"slack calls per message {report['slack_calls_per_message']} > {options.max_calls_per_message}")
+    if options.min_events_per_second is not None and report['events_per_second'] < options.min_events_per_second:
+        failures.append(f"events/sec {report['events_per_second']} < {options.min_events_per_second}")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the slack event handler against a fake Slack API and bot")
+    parser.add_argument('--bots', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help="requests in flight at the same time")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second, 0 sends them as fast as possible")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="share of each kind of message")
+    parser.add_argument('--slack-latency-ms', type=float, default=20)
+    parser.add_argument('--slack-jitter-ms', type=float, default=10)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0, help="share of slack calls answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After of the injected 429s")
+    parser.add_argument('--slack-limits', action='store_true', help="keep the client side slack rate limits")
+    parser.add_argument('--bot-latency-ms', type=float, default=200)
+    parser.add_argument('--max-retries', type=int, default=3, help="times an event that got no 2xx ack is sent again")
+    parser.add_argument('--retry-delay', type=float, default=1, help="seconds before the first retry, grows per retry")
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the handler's INFO logs")
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--max-calls-per-message', type=float)
+    parser.add_argument('--min-events-per-second', type=float)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = asyncio.run(run_benchmark(options))
+    print(json.dumps(report, indent=2) if options.json else format_report(report))
+    failures = check_thresholds(report, options)
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import re
+
+from .slackStores import create_store
+
+
+logger = logging.getLogger(__name__)
+
+# Markdown from the bot converted to slack mrkdwn, compiled once instead of on every response
+# First remove any double asterisks inside headers
+BOLD_HEADER_PATTERN = re.compile(r'### \*\*(.*?)\*\*')
+# Then handle all remaining bold patterns
+BOLD_PATTERN = re.compile(r'\*\*?|\*\*?')
+# Finally handle headers by replacing with bold
+HEADER_PATTERN = re.compile(r'### (.*?)(\n|$)')
+# Markdown image syntax ![alt_text](image_url), supports multiple images
+IMAGE_PATTERN = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+# Slack limits: text of a section block, blocks in one message, fallback text of one message
+MAX_SECTION_TEXT = 3000
+MAX_BLOCKS_PER_MESSAGE = 50
+MAX_MESSAGE_TEXT = 40000
+
+
+def format_message(message: str) -> str:
+    # Slack-friendly formatting
+    message = BOLD_HEADER_PATTERN.sub(r'### \1', message)
+    message = BOLD_PATTERN.sub('*', message)
+    return HEADER_PATTERN.sub(r'*\1*\2', message)
+
+
+def split_text(text: str, limit: int = MAX_SECTION_TEXT):
+    """
+    Splits text into pieces of at most limit characters, at a paragraph, line or word break when there is one
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            # Only break at a separator that keeps the piece reasonably full
+            cut = text.rfind(separator, 0, limit)
+            if cut > limit // 2:
+                break
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+class ImageValidator:
+    """
+    Checks that image urls in a bot response load before we put them in an image block (slack rejects the whole
+    message if one image url is broken). All urls of a response are checked at the same time under one deadline,
+    results are cached so the same image isn't checked again for every response.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, invalid_ttl_seconds: float = 300, max_entries: int = 10000):
+        self.invalid_ttl_seconds = invalid_ttl_seconds
+        self.store = create_store("images", ttl_seconds=ttl_seconds, max_entries=max_entries)
+
+    async def validate_all(self, http_client, image_urls, deadline: float = 5.0) -> dict:
+        """
+        Returns {image_url: True/False}, urls that didn't answer before the deadline count as invalid (and are not cached)
+        """
+        results = {}
+        checks = {}
+        for image_url in dict.fromkeys(image_urls):
+            cached = await self.store.get(image_url)
+            if cached is not None:
+                results[image_url] = cached
+            else:
+                checks[image_url] = asyncio.ensure_future(self._check(http_client, image_url, deadline))
+
+        if checks:
+            done, pending = await asyncio.wait(checks.values(), timeout=deadline)
+            for task in pending:
+                task.cancel()
+            for image_url, task in checks.items():
+                results[image_url] = task in done and task.result()
+        return results
+
+    async def _check(self, http_client, image_url: str, timeout: float) -> bool:
+        try:
+            response = await http_client.head(image_url, timeout=timeout)
+            valid = response.status_code == 200
+        except Exception:
+            valid = False
+        if valid:
+            await self.store.set(image_url, True)
+        else:
+            logger.warning("Skipping invalid image URL: %s", image_url)
+            await self.store.set(image_url, False, ttl_seconds=self.invalid_ttl_seconds)
+        return valid
+
+
+async def build_messages(message: str, http_client, image_validator: ImageValidator, deadline: float = 5.0):
+    """
+    Turns a bot response into slack messages with ordered text and image blocks. Returns a list of
+    {"text": fallback text, "blocks": [...]}, more than one when the response is over slack's size limits.
+    """
+    message = format_message(message)
+    matches = list(IMAGE_PATTERN.finditer(message))
+    valid_images = await image_validator.validate_all(
+        http_client, [match.group(2) for match in matches], deadline=deadline
+    ) if matches else {}
+
+    blocks = []
+    last_index = 0
+
+    def add_text(text):
+        for piece in split_text(text.strip()):
+            blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": piece}})
+
+    # Process text and images in the correct order
+    for match in matches:
+        alt_text, image_url = match.groups()
+        # Add text block before the image (if there's any)
+        add_text(message[last_index:match.start()])
+        if valid_images.get(image_url):
+            blocks.append({"type": "image", "image_url": image_url, "alt_text": alt_text or "image"})
+        last_index = match.end()
+
+    # Add remaining text after the last image
+    add_text(message[last_index:])
+
+    if not blocks:
+        return [{"text": message or "No response available", "blocks": []}]
+
+    # Split into as many messages as slack's block limit needs, each with its own fallback text
+    messages = []
+    for start in range(0, len(blocks), MAX_BLOCKS_PER_MESSAGE):
+        message_blocks = blocks[start:start + MAX_BLOCKS_PER_MESSAGE]
+        fallback_text = "\n\n".join(
+            block["text"]["text"] if block["type"] == "section" else block["alt_text"]
+            for block in message_blocks
+        )
+        messages.append({"text": fallback_text[:MAX_MESSAGE_TEXT], "blocks": message_blocks})
+    return messages
@@ -0,0 +1,48 @@
+import logging
+import time
+
+from .slackStores import create_store
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadContextStore:
+    """
+    Recent conversation turns and uploaded file paths of each thread, keyed by (token_key, channel, thread_uuid), so a
+    follow-up question can be sent to the bot with its context and with the files uploaded earlier in the thread,
+    without fetching the thread or uploading the files again. Threads are evicted by TTL and LRU (max_entries), and
+    each thread keeps at most max_turns turns of max_turn_chars characters and max_file_paths files. Use the sqlite backend to keep it across restarts.
+    """
+
+    def __init__(self, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 10000,
+                 max_turns: int = 20, max_turn_chars: int = 4000, max_file_paths: int = 50):
+        self.store = create_store("context", ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.max_turns = max_turns
+        self.max_turn_chars = max_turn_chars
+        self.max_file_paths = max_file_paths
+
+    async def get(self, token_key: str, channel: str, thread_uuid: str) -> dict:
+        """
+        Returns {"turns": [{"role", "text", "ts"}, ...], "file_paths": [...]} for the thread, empty if we don't know it
+        """
+        return await self.store.get((token_key, channel, thread_uuid)) or {"turns": [], "file_paths": []}
+
+    async def add_turns(self, token_key: str, channel: str, thread_uuid: str, turns):
+        """
+        Appends (role, text) turns, e.g. [("user", question), ("assistant", answer)], in one store write
+        """
+        context = await self.get(token_key, channel, thread_uuid)
+        ts = f"{time.time():.6f}"
+        for role, text in turns:
+            context["turns"].append({"role": role, "text": (text or "")[:self.max_turn_chars], "ts": ts})
+        context["turns"] = context["turns"][-self.max_turns:]
+        await self.store.set((token_key, channel, thread_uuid), context)
+
+    async def add_file_paths(self, token_key: str, channel: str, thread_uuid: str, file_paths):
+        context = await self.get(token_key, channel, thread_uuid)
+        new_paths = [path for path in file_paths if path not in context["file_paths"]]
+        if not new_paths:
+            return
+        context["file_paths"] = (context["file_paths"] + new_paths)[-self.max_file_paths:]
+        await self.store.set((token_key, channel, thread_uuid), context)
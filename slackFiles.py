@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a file's chunks in its download queue
+END_OF_FILE = None
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def guess_content_type(file_name: str) -> str:
+    return 'application/pdf' if file_name.lower().endswith('.pdf') else 'application/octet-stream'
+
+
+class StreamingFileUpload:
+    """
+    Pipes slack file downloads straight into one streaming multipart upload to the bot's file upload API,
+    without temp files and without holding whole files in memory. All downloads start at the same time,
+    each one buffers at most max_buffered_chunks chunks until the upload gets to it.
+    """
+
+    def __init__(self, http_client, slack_token: str, max_file_bytes: int = 50 * 1024 * 1024,
+                 file_timeout: float = 60, chunk_size: int = 64 * 1024, max_buffered_chunks: int = 16):
+        self.http_client = http_client
+        self.slack_token = slack_token
+        self.max_file_bytes = max_file_bytes
+        self.file_timeout = file_timeout
+        self.chunk_size = chunk_size
+        self.max_buffered_chunks = max_buffered_chunks
+        self.boundary = uuid.uuid4().hex
+        # Names of the files that made it into the upload
+        self.uploaded_files = []
+        self.skipped_files = []
+
+    async def upload(self, upload_url: str, files: list, form_data: dict, headers: dict):
+        """
+        Downloads the slack files and uploads them to upload_url as multipart/form-data, every file is sent as
+        a part named after the file. Returns the upload API's response.
+        """
+        queues = [asyncio.Queue(maxsize=self.max_buffered_chunks) for _ in files]
+        downloads = [
+            asyncio.ensure_future(self._download(file, queue))
+            for file, queue in zip(files, queues)
+        ]
+        try:
+            return await self.http_client.post(
+                upload_url,
+                headers={**headers, "Content-Type": f"multipart/form-data; boundary={self.boundary}"},
+                content=self._multipart_body(files, queues, form_data)
+            )
+        finally:
+            for download in downloads:
+                download.cancel()
+
+    async def _download(self, file: dict, queue: asyncio.Queue):
+        # The first item put in the queue is True once the download started fine, or the exception if it didn't.
+        # file_timeout only counts the time spent on the network, not the time waiting for the upload to take chunks.
+        file_name = file.get('name')
+        try:
+            async with asyncio.timeout(self.file_timeout) as network_timeout:
+                # Download file using bot token for authentication, provided by the slack api
+                async with self.http_client.stream(
+                    "GET",
+                    file.get('url_private_download'),
+                    headers={'Authorization': f'Bearer {self.slack_token}'}
+                ) as file_response:
+                    if file_response.status_code != 200:
+                        raise RuntimeError(f"download failed with status {file_response.status_code}")
+                    content_length = int(file_response.headers.get('Content-Length') or 0)
+                    if content_length > self.max_file_bytes:
+                        raise FileTooLarge(f"{content_length} bytes is over the {self.max_file_bytes} bytes limit")
+
+                    await queue.put(True)
+                    size = 0
+                    async for chunk in file_response.aiter_bytes(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise FileTooLarge(f"file is over the {self.max_file_bytes} bytes limit")
+                        await self._put(queue, chunk, network_timeout)
+            logger.info("Successfully downloaded file: %s (%s bytes)", file_name, size)
+            await queue.put(END_OF_FILE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error downloading file %s: %r", file_name, e)
+            await queue.put(e)
+
+    async def _put(self, queue: asyncio.Queue, chunk: bytes, network_timeout: asyncio.Timeout):
+        if not queue.full():
+            queue.put_nowait(chunk)
+            return
+        # The upload is busy with an earlier file or chunk, stop the clock until it has room for this one
+        loop = asyncio.get_running_loop()
+        remaining = network_timeout.when() - loop.time()
+        network_timeout.reschedule(None)
+        try:
+            await queue.put(chunk)
+        finally:
+            network_timeout.reschedule(loop.time() + remaining)
+
+    async def _multipart_body(self, files: list, queues: list, form_data: dict):
+        for name, value in form_data.items():
+            yield (
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            ).encode()
+
+        for file, queue in zip(files, queues):
+            file_name = file.get('name')
+            first = await queue.get()
+            if isinstance(first, Exception):
+                # Download failed before sending anything, upload the other files without it
+                self.skipped_files.append(file_name)
+                continue
+
+            yield (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{file_name}"; filename="{file_name}"\r\n'
+                f'Content-Type: {guess_content_type(file_name)}\r\n\r\n'
+            ).encode()
+            while True:
+                chunk = await queue.get()
+                if chunk is END_OF_FILE:
+                    break
+                if isinstance(chunk, Exception):
+                    # Part of the file was already sent, the whole upload has to be abandoned
+                    raise chunk
+                yield chunk
+            yield b'\r\n'
+            self.uploaded_files.append(file_name)
+
+        yield f'--{self.boundary}--\r\n'.encode()
@@ -0,0 +1,361 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+def replica_id() -> str:
+    # Owner of the events this process accepted, unique per process start
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class EventProgress:
+    """
+    What processing an event already posted to slack ("placeholder_ts", "reply_ts"), saved in the journal as soon as it
+    is posted, so a replay of the event after a crash reuses the placeholder and doesn't answer a second time.
+    Without a journal it only remembers them in memory.
+    """
+
+    def __init__(self, journal=None, token_key: str = None, event_id: str = None, markers: dict = None):
+        self.journal = journal
+        self.token_key = token_key
+        self.event_id = event_id
+        self.markers = dict(markers or {})
+
+    def get(self, name: str):
+        return self.markers.get(name)
+
+    async def save(self, **markers):
+        self.markers.update(markers)
+        if self.journal is None:
+            return
+        try:
+            await self.journal.save_progress(self.token_key, self.event_id, self.markers)
+        except Exception as e:
+            logger.error("Error saving the progress of event %s to the journal: %r", self.event_id, e)
+
+
+class SQLiteEventJournal:
+    """
+    Journal of accepted slack events in a SQLite WAL file, so events that were acked but not answered when the process
+    stopped (restart, crash) are processed again instead of being lost. Every unfinished event has an owner and a lease
+    the owner renews while it runs, any process using the file claims the events whose lease ran out. SQLite's WAL mode
+    only works on one host, replicas on several hosts need RedisEventJournal.
+    Writes are group committed: everything queued within batch_interval goes into one transaction, so an event waits
+    for one shared commit before it is acked.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 60, batch_interval: float = 0.005, max_batch: int = 500,
+                 retention_seconds: float = 24 * 3600, synchronous: str = "NORMAL"):
+        self.path = path
+        self.owner = replica_id()
+        self.lease_seconds = lease_seconds
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        # (sql, params, future or None) waiting for the next commit
+        self._writes = []
+        self._flusher = None
+        self._heartbeat = None
+        self._commits = 0
+        # Own thread for the commits, the default executor can be busy with execute_bot calls
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="slack-journal")
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL survives a crash of the process, FULL also a crash of the machine
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS slack_events ("
+            "token_key TEXT NOT NULL, event_id TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, progress TEXT NOT NULL DEFAULT '{}', owner TEXT, "
+            "lease_until REAL NOT NULL, accepted_at REAL NOT NULL, finished_at REAL, "
+            "PRIMARY KEY (token_key, event_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS slack_events_lease ON slack_events (status, lease_until)")
+
+    async def start(self):
+        self._heartbeat = asyncio.ensure_future(self._renew_leases())
+
+    async def _renew_leases(self):
+        # Keeps the events this process is still working on from being claimed by another one
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._write(
+                    "UPDATE slack_events SET lease_until = ? WHERE owner = ? AND status = 'pending'",
+                    (time.time() + self.lease_seconds, self.owner)
+                )
+            except Exception as e:
+                logger.error("Error renewing the event journal leases: %r", e)
+
+    async def append(self, token_key: str, event_id: str, payload: dict):
+        """
+        Returns once the event is committed. A redelivered event that is already in the journal is left as it is.
+        """
+        now = time.time()
+        await self._write(
+            "INSERT OR IGNORE INTO slack_events (token_key, event_id, payload, status, owner, lease_until, accepted_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (token_key, event_id, json.dumps(payload), self.owner, now + self.lease_seconds, now)
+        )
+
+    async def save_progress(self, token_key: str, event_id: str, progress: dict):
+        # Waits for the commit, the marker has to be in the journal before it counts as posted
+        await self._write(
+            "UPDATE slack_events SET progress = ? WHERE token_key = ? AND event_id = ?",
+            (json.dumps(progress), token_key, event_id)
+        )
+
+    async def mark_done(self, token_key: str, event_id: str):
+        # Doesn't wait for the commit, a replay after a crash finds the reply marker and doesn't post again
+        self._queue(
+            "UPDATE slack_events SET status = 'done', finished_at = ? WHERE token_key = ? AND event_id = ?",
+            (time.time(), token_key, event_id)
+        )
+
+    async def discard(self, token_key: str, event_id: str):
+        # For events we didn't accept after all (worker pool full), slack sends them again
+        self._queue("DELETE FROM slack_events WHERE token_key = ? AND event_id = ?", (token_key, event_id))
+
+    async def claim_expired(self, limit: int = 100):
+        """
+        Takes over up to limit unfinished events whose owner stopped renewing their lease. Returns
+        [(token_key, event_id, payload, attempts, progress), ...], attempts counts this claim.
+        """
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._claim_expired, limit)
+
+    def _claim_expired(self, limit: int):
+        now = time.time()
+        with self._lock:
+            # Takes the write lock right away, two processes can't claim the same event
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT token_key, event_id, payload, attempts, progress FROM slack_events "
+                    "WHERE status = 'pending' AND lease_until < ? ORDER BY accepted_at LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                for token_key, event_id, _, _, _ in rows:
+                    self._conn.execute(
+                        "UPDATE slack_events SET owner = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE token_key = ? AND event_id = ?",
+                        (self.owner, now + self.lease_seconds, token_key, event_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [
+            (token_key, event_id, json.loads(payload), attempts + 1, json.loads(progress))
+            for token_key, event_id, payload, attempts, progress in rows
+        ]
+
+    def _queue(self, sql: str, params: tuple, future=None):
+        self._writes.append((sql, params, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_soon())
+
+    async def _write(self, sql: str, params: tuple):
+        future = asyncio.get_running_loop().create_future()
+        self._queue(sql, params, future)
+        await future
+
+    async def _flush_soon(self):
+        await asyncio.sleep(self.batch_interval)
+        await self.flush()
+
+    async def flush(self):
+        while self._writes:
+            batch, self._writes = self._writes[:self.max_batch], self._writes[self.max_batch:]
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._commit, [(sql, params) for sql, params, _ in batch]
+                )
+            except Exception as e:
+                logger.error("Error writing %s entries to the event journal: %r", len(batch), e)
+                for _, _, future in batch:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                continue
+            for _, _, future in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+    def _commit(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._commits += 1
+            if self._commits % 1000 == 0:
+                # Finished events are only kept for a while
+                self._conn.execute(
+                    "DELETE FROM slack_events WHERE status = 'done' AND finished_at <= ?",
+                    (time.time() - self.retention_seconds,)
+                )
+
+    async def close(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        # Events this process didn't finish can be claimed right away instead of when the lease runs out
+        self._queue("UPDATE slack_events SET lease_until = 0 WHERE owner = ? AND status = 'pending'", (self.owner,))
+        await self.flush()
+        self._executor.shutdown()
+        with self._lock:
+            self._conn.close()
+
+
+class RedisEventJournal:
+    """
+    The event journal in Redis, shared by all replicas: when a replica is scaled in or crashes, the events it didn't
+    finish are claimed by another replica once their lease runs out. Needs the redis package.
+    Each event is a hash (payload, status, attempts, progress), and one sorted set holds the lease of every unfinished event.
+    """
+
+    def __init__(self, url: str, lease_seconds: float = 60, retention_seconds: float = 24 * 3600, prefix: str = "slack:journal"):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("The redis event journal needs the redis package, run: pip install redis")
+        self._redis = redis.asyncio.Redis.from_url(url, decode_responses=True)
+        self.owner = replica_id()
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self.prefix = prefix
+        self._leases_key = f"{prefix}:leases"
+        # Lease members of the unfinished events this replica owns
+        self._owned = set()
+        self._heartbeat = None
+
+    def _event_key(self, token_key: str, event_id: str) -> str:
+        return f"{self.prefix}:event:{token_key}:{event_id}"
+
+    def _member(self, token_key: str, event_id: str) -> str:
+        return json.dumps([token_key, event_id])
+
+    async def start(self):
+        self._heartbeat = asyncio.ensure_future(self._renew_leases())
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not self._owned:
+                continue
+            lease_until = time.time() + self.lease_seconds
+            try:
+                await self._redis.zadd(self._leases_key, {member: lease_until for member in self._owned}, xx=True)
+            except Exception as e:
+                logger.error("Error renewing the event journal leases: %r", e)
+
+    async def append(self, token_key: str, event_id: str, payload: dict):
+        key = self._event_key(token_key, event_id)
+        member = self._member(token_key, event_id)
+        now = time.time()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            # A redelivered event that is already in the journal keeps its fields
+            pipe.hsetnx(key, "payload", json.dumps(payload))
+            pipe.hsetnx(key, "status", "pending")
+            pipe.hsetnx(key, "attempts", 0)
+            pipe.hsetnx(key, "progress", "{}")
+            pipe.hsetnx(key, "accepted_at", now)
+            pipe.expire(key, int(self.retention_seconds))
+            pipe.zadd(self._leases_key, {member: now + self.lease_seconds}, nx=True)
+            await pipe.execute()
+        self._owned.add(member)
+
+    async def save_progress(self, token_key: str, event_id: str, progress: dict):
+        await self._redis.hset(self._event_key(token_key, event_id), "progress", json.dumps(progress))
+
+    async def mark_done(self, token_key: str, event_id: str):
+        key = self._event_key(token_key, event_id)
+        member = self._member(token_key, event_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"status": "done", "finished_at": time.time()})
+            pipe.zrem(self._leases_key, member)
+            await pipe.execute()
+        self._owned.discard(member)
+
+    async def discard(self, token_key: str, event_id: str):
+        member = self._member(token_key, event_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._event_key(token_key, event_id))
+            pipe.zrem(self._leases_key, member)
+            await pipe.execute()
+        self._owned.discard(member)
+
+    async def claim_expired(self, limit: int = 100):
+        """
+        Takes over up to limit unfinished events whose owner stopped renewing their lease. Returns
+        [(token_key, event_id, payload, attempts, progress), ...], attempts counts this claim.
+        """
+        expired = await self._redis.zrangebyscore(self._leases_key, "-inf", time.time(), start=0, num=limit, withscores=True)
+        claimed = []
+        for member, lease_until in expired:
+            # Only one replica gets the claim of this lease, the others find the claim key taken
+            claim_key = f"{self.prefix}:claim:{member}:{lease_until}"
+            if not await self._redis.set(claim_key, self.owner, nx=True, px=int(self.lease_seconds * 1000)):
+                continue
+            token_key, event_id = json.loads(member)
+            key = self._event_key(token_key, event_id)
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.zadd(self._leases_key, {member: time.time() + self.lease_seconds}, xx=True)
+                pipe.hincrby(key, "attempts", 1)
+                pipe.hgetall(key)
+                _, attempts, entry = await pipe.execute()
+            if entry.get("status") != "pending" or "payload" not in entry:
+                # Finished meanwhile, or expired from redis
+                await self._redis.zrem(self._leases_key, member)
+                if "payload" not in entry:
+                    await self._redis.delete(key)
+                continue
+            self._owned.add(member)
+            claimed.append((token_key, event_id, json.loads(entry["payload"]), int(attempts), json.loads(entry["progress"])))
+        return claimed
+
+    async def close(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        if self._owned:
+            # Events this replica didn't finish can be claimed right away instead of when the lease runs out
+            await self._redis.zadd(self._leases_key, {member: 0 for member in self._owned}, xx=True)
+        await self._redis.aclose()
+
+
+def create_event_journal():
+    """
+    The event journal from the environment, None unless SLACK_EVENT_JOURNAL=true. SLACK_EVENT_JOURNAL_BACKEND is sqlite
+    (default, file at SLACK_EVENT_JOURNAL_PATH) for one host, or redis (REDIS_URL) for replicas on several hosts.
+    """
+    if os.getenv('SLACK_EVENT_JOURNAL', 'false').lower() != 'true':
+        return None
+    backend = os.getenv('SLACK_EVENT_JOURNAL_BACKEND', 'sqlite').lower()
+    lease_seconds = float(os.getenv('SLACK_EVENT_JOURNAL_LEASE_SECONDS', '60'))
+    if backend == "redis":
+        logger.info("Using redis event journal")
+        return RedisEventJournal(os.getenv("REDIS_URL", "redis://localhost:6379/0"), lease_seconds=lease_seconds)
+    if backend != "sqlite":
+        raise ValueError(f"Unknown event journal backend: {backend}")
+    path = os.getenv('SLACK_EVENT_JOURNAL_PATH', 'slack_events.db')
+    logger.info("Using sqlite event journal: %s", path)
+    return SQLiteEventJournal(
+        path,
+        lease_seconds=lease_seconds,
+        batch_interval=float(os.getenv('SLACK_EVENT_JOURNAL_BATCH_SECONDS', '0.005')),
+        synchronous=os.getenv('SLACK_EVENT_JOURNAL_SYNCHRONOUS', 'NORMAL').upper()
+    )
@@ -0,0 +1,191 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+
+
+# Set per event so every log line of that event (also from worker tasks and threads) carries the same ids
+log_context = contextvars.ContextVar("slack_log_context", default={})
+
+# Keys whose values never end up in the logs, matched case insensitively anywhere in a dict
+SECRET_KEYS = {"slack_token", "signing_secret", "token", "bot_token", "client_secret", "authorization", "x-slack-signature"}
+# Slack tokens and bearer tokens that show up inside strings (exception messages, urls ...)
+SECRET_PATTERN = re.compile(r'xox[abposre]-[A-Za-z0-9-]+|(?<=Bearer )[A-Za-z0-9._~+/=-]+')
+REDACTED = "[REDACTED]"
+
+# Fraction of events whose full payloads are logged, and how much of each payload
+PAYLOAD_SAMPLE_RATE = float(os.getenv('SLACK_LOG_PAYLOAD_SAMPLE_RATE', '0'))
+MAX_PAYLOAD_CHARS = int(os.getenv('SLACK_LOG_MAX_PAYLOAD_CHARS', '2000'))
+
+_listener = None
+
+
+def bind_event(token_key: str, event_id: str = None):
+    """
+    Sets the correlation id for the current event, for the rest of the current task and the tasks it starts.
+    Also decides once whether the event's payloads are logged, so a sampled event has all of them.
+    """
+    sampled = PAYLOAD_SAMPLE_RATE >= 1 or (PAYLOAD_SAMPLE_RATE > 0 and random.random() < PAYLOAD_SAMPLE_RATE)
+    log_context.set({"token_key": token_key, "event_id": event_id or "", "sampled": sampled})
+
+
+def redact(data):
+    if isinstance(data, dict):
+        return {
+            key: REDACTED if str(key).lower() in SECRET_KEYS else redact(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, (list, tuple)):
+        return [redact(value) for value in data]
+    if isinstance(data, str):
+        return SECRET_PATTERN.sub(REDACTED, data)
+    return data
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if max_chars and len(text) > max_chars:
+        return f"{text[:max_chars]}... [{len(text) - max_chars} more chars]"
+    return text
+
+
+class PayloadDump:
+    """
+    Log argument that only serializes the payload when the line is actually written, redacted and truncated
+    """
+
+    def __init__(self, data, max_chars: int):
+        self.data = data
+        self.max_chars = max_chars
+
+    def __str__(self):
+        data = self.data
+        if hasattr(data, 'items') and not isinstance(data, dict):
+            # Headers and other mappings
+            data = dict(data.items())
+        try:
+            text = json.dumps(redact(data), default=str)
+        except (TypeError, ValueError):
+            text = redact(str(data))
+        return truncate(text, self.max_chars)
+
+
+def log_payload(logger, name: str, data):
+    """
+    Logs a full payload (slack event, bot request or response) if the current event was sampled in bind_event
+    (default none)
+    """
+    if not log_context.get().get("sampled") or not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info("%s: %s", name, PayloadDump(data, MAX_PAYLOAD_CHARS))
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the event correlation ids onto the record. Runs in the thread that logs, before the record is queued.
+    """
+
+    def filter(self, record):
+        context = log_context.get()
+        record.token_key = context.get("token_key", "")
+        record.event_id = context.get("event_id", "")
+        return True
+
+
+class RedactingFormatter(logging.Formatter):
+    """
+    Plain text lines like before, with the event id added and secrets and long messages cut out
+    """
+
+    def __init__(self, fmt=None, max_chars: int = 0):
+        super().__init__(fmt)
+        self.max_chars = max_chars
+
+    def formatMessage(self, record):
+        record.message = truncate(SECRET_PATTERN.sub(REDACTED, record.message), self.max_chars)
+        if getattr(record, "event_id", ""):
+            record.message = f"[{record.event_id}] {record.message}"
+        return super().formatMessage(record)
+
+    def formatException(self, exc_info):
+        return SECRET_PATTERN.sub(REDACTED, super().formatException(exc_info))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log collectors that index fields
+    """
+
+    def __init__(self, max_chars: int = 0):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(SECRET_PATTERN.sub(REDACTED, record.getMessage()), self.max_chars),
+        }
+        if getattr(record, "token_key", ""):
+            entry["token_key"] = record.token_key
+        if getattr(record, "event_id", ""):
+            entry["event_id"] = record.event_id
+        if record.exc_info:
+            entry["exception"] = SECRET_PATTERN.sub(REDACTED, self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues the record as it is. QueueHandler.prepare would format it in the thread that logs and drop exc_info, this way
+    formatting (and PayloadDump serialization) happens on the listener thread and the formatter still gets the exception.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging():
+    """
+    Sets up the root logger from the environment:
+    SLACK_LOG_FORMAT text (default) or json, SLACK_LOG_LEVEL (default INFO), SLACK_LOG_MAX_CHARS cuts long messages
+    (default 4000) and SLACK_LOG_QUEUE (default true) writes to stdout from a background thread so a slow log pipe
+    never blocks the event loop.
+    """
+    global _listener
+    max_chars = int(os.getenv('SLACK_LOG_MAX_CHARS', '4000'))
+    if os.getenv('SLACK_LOG_FORMAT', 'text').lower() == 'json':
+        formatter = JsonFormatter(max_chars=max_chars)
+    else:
+        formatter = RedactingFormatter("%(asctime)s [%(levelname)s] %(message)s", max_chars=max_chars)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    if os.getenv('SLACK_LOG_QUEUE', 'true').lower() == 'true':
+        handler = RecordQueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(handler.queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        handler = stream_handler
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.getenv('SLACK_LOG_LEVEL', 'INFO').upper())
+
+
+def stop_logging():
+    # Writes out what is still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
@@ -0,0 +1,135 @@
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds, covers everything from a cached lookup to a slow bot answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(labelnames, labelvalues) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in self._values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labelvalues -> [count per bucket..., sum, count]
+        self._values = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self._values.get(labelvalues)
+        if series is None:
+            series = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labelnames = tuple(self.labelnames) + ("le",)
+        for labelvalues, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labelnames, labelvalues + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(bucket_labelnames, labelvalues + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {series[-1]}")
+        return lines
+
+
+class Metrics:
+    """
+    Per stage timers and per event outcomes for the slack event handler, rendered in the prometheus text format.
+    When disabled, stage() returns a shared no-op context manager and nothing is recorded.
+    Stages can also be exported as OpenTelemetry spans when the opentelemetry package is installed.
+    """
+
+    def __init__(self, enabled: bool = True, otel_enabled: bool = False):
+        self.enabled = enabled
+        self.stage_seconds = Histogram(
+            "slack_stage_seconds", "Time spent in each stage of handling a slack event", ("stage", "token_key")
+        )
+        self.event_seconds = Histogram(
+            "slack_event_seconds", "Time to process a slack event, by outcome", ("token_key", "outcome")
+        )
+        self.events = Counter("slack_events_total", "Slack events by outcome", ("token_key", "outcome"))
+        # Functions returning [(name, type, help, labelnames, {labelvalues: value})], read when /metrics is scraped,
+        # for numbers other objects already keep (cache hits, worker pool, rate limits)
+        self._collectors = []
+        self._noop = nullcontext()
+        self._tracer = None
+        if otel_enabled:
+            try:
+                from opentelemetry import trace
+                self._tracer = trace.get_tracer("slackApp")
+            except ImportError:
+                logger.warning("OpenTelemetry export needs the opentelemetry-api package, spans are disabled")
+
+    def stage(self, name: str, token_key: str = ""):
+        if not self.enabled:
+            return self._noop
+        return self._timed_stage(name, token_key)
+
+    @contextmanager
+    def _timed_stage(self, name: str, token_key: str):
+        started = time.perf_counter()
+        span = self._tracer.start_as_current_span(name, attributes={"slack.token_key": token_key}) if self._tracer else self._noop
+        try:
+            with span:
+                yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - started, name, token_key)
+
+    def observe_event(self, token_key: str, outcome: str, seconds: float):
+        if not self.enabled:
+            return
+        self.events.inc(token_key, outcome)
+        self.event_seconds.observe(seconds, token_key, outcome)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stage_seconds, self.event_seconds, self.events):
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, help_text, labelnames, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labelvalues, value in samples.items():
+                    lines.append(f"{name}{format_labels(labelnames, labelvalues)} {value}")
+        return "\n".join(lines) + "\n"
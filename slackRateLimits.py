@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from slack_sdk.errors import SlackApiError
+
+
+logger = logging.getLogger(__name__)
+
+# Lower value goes first: messages the user is waiting to see before lookups
+PRIORITY_REPLY = 0
+PRIORITY_LOOKUP = 1
+
+# Slack's documented rate limit tiers, requests per minute
+TIER_RATES = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "auth.test": 4,
+    "users.info": 4,
+    "users.list": 2,
+    "conversations.replies": 3,
+    "chat.update": 3,
+    "chat.delete": 3,
+}
+DEFAULT_TIER = 3
+REPLY_METHODS = {"chat.postMessage", "chat.update", "chat.delete"}
+# chat.postMessage has its own limit of about one message per second per channel
+POST_MESSAGE_RATE = 1.0
+POST_MESSAGE_BURST = 3
+
+
+class TokenBucket:
+    """
+    Token bucket where waiting callers are served by priority (then in arrival order), and which can be
+    blocked for a while when slack answers 429 with a Retry-After
+    """
+
+    def __init__(self, rate_per_second: float, burst: float):
+        self.rate = rate_per_second
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._granter = None
+
+    def _try_take(self) -> bool:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: int = PRIORITY_LOOKUP) -> float:
+        """
+        Waits for a token, returns how long we waited
+        """
+        if not self._waiters and self._try_take():
+            return 0.0
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.ensure_future(self._grant())
+        await waiter
+        return time.monotonic() - started
+
+    async def _grant(self):
+        while self._waiters:
+            # Callers that gave up (cancelled) don't get a token
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            if self._try_take():
+                heapq.heappop(self._waiters)[2].set_result(None)
+                continue
+            now = time.monotonic()
+            await asyncio.sleep(max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.01))
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now: float) -> bool:
+        # Nobody waiting and refilled to capacity, a new bucket would behave the same
+        return (
+            not self._waiters
+            and now >= self.blocked_until
+            and self.tokens + (now - self.updated) * self.rate >= self.capacity
+        )
+
+
+class RateLimitScheduler:
+    """
+    Coordinates the slack API calls of all bots in the process. Every bot (token key) has its own bucket per API
+    method at the rate of the method's tier, like slack counts them, and chat.postMessage one per channel, so one
+    chatty bot can't use up another bot's budget. On top of that every call of a bot takes a token from the bot's
+    budget of bot_calls_per_second (0 for none), shared by all its methods and served by priority, so when the bot is
+    busy its replies go before its lookups. 429s block the method's bucket for Retry-After seconds and the call is
+    retried with jitter. Buckets that are idle are dropped every eviction_interval seconds.
+    """
+
+    def __init__(self, max_retries: int = 3, burst_seconds: float = 10, eviction_interval: float = 300,
+                 bot_calls_per_second: float = 20):
+        self.max_retries = max_retries
+        self.burst_seconds = burst_seconds
+        self.eviction_interval = eviction_interval
+        self.bot_calls_per_second = bot_calls_per_second
+        self._buckets = {}
+        self._evicted_at = time.monotonic()
+        self.calls = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+    def bucket_for(self, token_key: str, method: str, channel: str = None) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._evicted_at >= self.eviction_interval:
+            self._evict_idle(now)
+        if method == "chat.postMessage":
+            key = (token_key, method, channel)
+        else:
+            key = (token_key, method)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if method == "chat.postMessage":
+                rate, burst = POST_MESSAGE_RATE, POST_MESSAGE_BURST
+            else:
+                rate = TIER_RATES[METHOD_TIERS.get(method, DEFAULT_TIER)] / 60
+                burst = max(1, rate * self.burst_seconds)
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def budget_for(self, token_key: str) -> TokenBucket:
+        # The bot's budget shared by all its methods, None without one
+        if not self.bot_calls_per_second:
+            return None
+        key = (token_key,)
+        budget = self._buckets.get(key)
+        if budget is None:
+            rate = self.bot_calls_per_second
+            budget = self._buckets[key] = TokenBucket(rate, max(1, rate * self.burst_seconds))
+        return budget
+
+    def _evict_idle(self, now: float):
+        # One chat.postMessage bucket per channel ever posted to would otherwise pile up for the life of the process
+        self._evicted_at = now
+        idle = [key for key, bucket in self._buckets.items() if bucket.is_idle(now)]
+        for key in idle:
+            del self._buckets[key]
+        if idle:
+            logger.debug("Dropped %s idle rate limit buckets, %s left", len(idle), len(self._buckets))
+
+    async def call(self, token_key: str, method: str, api_call, kwargs: dict, priority: int = None):
+        if priority is None:
+            priority = PRIORITY_REPLY if method in REPLY_METHODS else PRIORITY_LOOKUP
+        bucket = self.bucket_for(token_key, method, kwargs.get('channel'))
+        budget = self.budget_for(token_key)
+        attempt = 0
+        while True:
+            self.calls += 1
+            waited = await bucket.acquire(priority)
+            if budget is not None:
+                # Taken last, a call waiting on its method's bucket doesn't hold back the bot's other calls
+                waited += await budget.acquire(priority)
+            if waited > 0:
+                self.throttled += 1
+                logger.info("Waited %.2fs for the %s rate limit of %s", waited, method, token_key)
+            try:
+                return await api_call(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                self.rate_limited += 1
+                retry_after = float(e.response.headers.get('Retry-After', e.response.headers.get('retry-after', 1)))
+                bucket.block(retry_after)
+                logger.warning("Slack rate limited %s for %s, retrying after %ss", method, token_key, retry_after)
+            attempt += 1
+            self.retries += 1
+            # Jitter so the callers blocked on the same bucket don't all retry at the same moment
+            await asyncio.sleep(random.uniform(0, 0.5) * attempt)
+
+    def metrics(self) -> dict:
+        return {
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "buckets": len(self._buckets),
+        }
+
+
+class RateLimitedClient:
+    """
+    Wraps a bot's AsyncWebClient so every API method (client.chat_postMessage(...) etc) goes through the scheduler.
+    Pass _priority=PRIORITY_REPLY/PRIORITY_LOOKUP to override the default lane of a call.
+    """
+
+    def __init__(self, client, scheduler: RateLimitScheduler, token_key: str):
+        self.client = client
+        self.scheduler = scheduler
+        self.token_key = token_key
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or '_' not in name or not callable(attribute):
+            return attribute
+        # chat_postMessage -> chat.postMessage
+        method = name.replace('_', '.', 1)
+
+        async def call(_priority: int = None, **kwargs):
+            return await self.scheduler.call(self.token_key, method, attribute, kwargs, priority=_priority)
+        return call
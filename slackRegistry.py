@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from slack_sdk.signature import SignatureVerifier
+
+
+logger = logging.getLogger(__name__)
+
+
+class BotEntry:
+    def __init__(self, client, signature_verifier: SignatureVerifier, credentials: dict):
+        self.client = client
+        self.signature_verifier = signature_verifier
+        self.credentials = credentials
+        # Bot user id from auth.test, resolved on first use
+        self.bot_user_id = None
+        self.loaded_at = time.monotonic()
+
+
+class BotRegistry:
+    """
+    One place for every bot's slack client, signature verifier, credentials and bot user id.
+    Credentials are reloaded from the DB after ttl_seconds so rotated tokens are picked up, concurrent first requests for
+    a bot share one DB load, and failed loads are remembered with a growing backoff so an unknown token key doesn't hit
+    the DB on every request. At most max_failures failed token keys are remembered, the oldest are dropped first.
+    """
+
+    def __init__(self, load_credentials, create_client, ttl_seconds: float = 3600,
+                 negative_ttl_seconds: float = 30, max_backoff_seconds: float = 600, max_failures: int = 10000):
+        # load_credentials(token_key) is synchronous (DB call) and runs in a thread, create_client(token_key, slack_token) builds the client
+        self.load_credentials = load_credentials
+        self.create_client = create_client
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_failures = max_failures
+        self._entries = {}
+        self._loading = {}
+        self._resolving = {}
+        # token_key -> (retry_at, consecutive failures), oldest failure first
+        self._failures = OrderedDict()
+        self.db_loads = 0
+
+    async def get(self, token_key: str):
+        """
+        Returns the BotEntry for the token key, or None if the bot can't be loaded
+        """
+        entry = self._entries.get(token_key)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl_seconds:
+            return entry
+
+        failure = self._failures.get(token_key)
+        if failure is not None and time.monotonic() < failure[0]:
+            # Still backing off, keep serving the old entry if we had one
+            return entry
+
+        # Single flight: concurrent requests for the same bot wait for the same DB load
+        loading = self._loading.get(token_key)
+        if loading is None:
+            loading = self._loading[token_key] = asyncio.ensure_future(self._load(token_key, entry))
+            loading.add_done_callback(lambda _: self._loading.pop(token_key, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, token_key: str, old_entry):
+        try:
+            self.db_loads += 1
+            # Get credentials from database, bot's token key etc
+            bot_creds = await asyncio.to_thread(self.load_credentials, token_key)
+        except Exception as e:
+            failures = self._failures.get(token_key, (0, 0))[1] + 1
+            backoff = min(self.negative_ttl_seconds * 2 ** (failures - 1), self.max_backoff_seconds)
+            self._failures[token_key] = (time.monotonic() + backoff, failures)
+            self._failures.move_to_end(token_key)
+            # Token keys come from the request url, a flood of made up ones must not grow this for ever
+            while len(self._failures) > self.max_failures:
+                self._failures.popitem(last=False)
+            logger.error("Error getting bot credentials(slack) for %s: %s, retrying in %.0fs", token_key, e, backoff)
+            return old_entry
+
+        self._failures.pop(token_key, None)
+        if old_entry is not None and old_entry.credentials.get('slack_token') == bot_creds['slack_token']:
+            # Token didn't change, keep the client and the resolved bot user id
+            old_entry.credentials = bot_creds
+            old_entry.signature_verifier = SignatureVerifier(bot_creds['signing_secret'])
+            old_entry.loaded_at = time.monotonic()
+            return old_entry
+
+        # Initialize new client with database credentials, we need slack token and signing secret for connecting to slack bot
+        entry = BotEntry(
+            self.create_client(token_key, bot_creds['slack_token']),
+            SignatureVerifier(bot_creds['signing_secret']),
+            bot_creds
+        )
+        self._entries[token_key] = entry
+        logger.info("Loaded bot credentials for token key: %s", token_key)
+        return entry
+
+    async def get_bot_user_id(self, token_key: str, refresh: bool = False):
+        """
+        auth.test only needs to run once per bot, the bot user id is kept with the client
+        """
+        entry = await self.get(token_key)
+        if entry is None:
+            return None
+        if entry.bot_user_id is not None and not refresh:
+            return entry.bot_user_id
+
+        resolving = self._resolving.get(token_key)
+        if resolving is None:
+            resolving = self._resolving[token_key] = asyncio.ensure_future(entry.client.auth_test())
+            resolving.add_done_callback(lambda _: self._resolving.pop(token_key, None))
+        auth_response = await asyncio.shield(resolving)
+        entry.bot_user_id = auth_response['user_id']
+        logger.info("Resolved bot user id for %s: %s", token_key, entry.bot_user_id)
+        return entry.bot_user_id
+
+    def cached_bot_user_id(self, token_key: str):
+        # The bot user id if it was resolved before, without loading credentials or calling auth.test
+        entry = self._entries.get(token_key)
+        return entry.bot_user_id if entry is not None else None
+
+    def invalidate(self, token_key: str):
+        # Call this after rotating a bot's slack token, the next event loads the credentials again and re-runs auth.test
+        self._entries.pop(token_key, None)
+        self._failures.pop(token_key, None)
+        logger.info("Cleared cached client and bot identity for token key: %s", token_key)
+
+    async def prewarm(self, token_keys):
+        """
+        Loads the credentials and bot user id of every configured bot, so the first message to a bot doesn't pay for them
+        """
+        async def warm(token_key):
+            try:
+                await self.get_bot_user_id(token_key)
+            except Exception as e:
+                logger.error("Error prewarming bot %s: %s", token_key, e)
+
+        await asyncio.gather(*(warm(token_key) for token_key in token_keys))
+        logger.info("Prewarmed %s/%s bots", len([key for key in token_keys if key in self._entries]), len(token_keys))
+
+    def loaded_entries(self):
+        # (token_key, BotEntry) of the bots loaded so far, also past their TTL, without loading or reloading any
+        return list(self._entries.items())
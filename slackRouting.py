@@ -0,0 +1,78 @@
+from .slackThreads import extract_mentions
+
+
+# Routing decisions
+REPLY = "reply"
+IGNORE = "ignore"
+NEEDS_LOOKUP = "needs_lookup"
+
+
+def route_event(event: dict, bot_user_id: str = None, thread_owner: dict = None, mentions=None):
+    """
+    Decides from what we already know whether this bot has to answer the event, without any slack call or other I/O.
+    bot_user_id is the bot's cached user id and thread_owner the cached thread ownership entry ({"root_mentions",
+    "last_bot"}), either can be None when not known yet. Returns (decision, reason) where decision is REPLY, IGNORE or
+    NEEDS_LOOKUP; only NEEDS_LOOKUP needs the slack API (auth.test, users.info or conversations.replies) to decide.
+    """
+    if event.get('bot_id'):
+        return IGNORE, "message from a bot"
+    if bot_user_id is None:
+        return NEEDS_LOOKUP, "bot user id not resolved yet"
+    if event.get('user') == bot_user_id:
+        return IGNORE, "bot's own message"
+
+    if mentions is None:
+        mentions = extract_mentions(event.get('text') or '')
+    is_dm = event.get('channel_type') == "im"
+    if len(mentions) > 1:
+        # Whether several bots were mentioned depends on the user profiles, the mentioned bots deal with it
+        if is_dm or bot_user_id in mentions:
+            return NEEDS_LOOKUP, "several users mentioned"
+        return IGNORE, "several users mentioned, not this bot"
+    if is_dm:
+        return REPLY, "direct message"
+    if mentions and mentions[0] != bot_user_id:
+        return IGNORE, "another user mentioned"
+
+    thread_ts = event.get('thread_ts')
+    if not thread_ts or thread_ts == event.get('ts'):
+        if mentions:
+            return REPLY, "mentioned in a channel message"
+        return IGNORE, "channel message without a mention of this bot"
+
+    if thread_owner is None:
+        return NEEDS_LOOKUP, "thread not in the thread index"
+    if bot_user_id in thread_owner['root_mentions'] or thread_owner['last_bot'] == bot_user_id:
+        return REPLY, "thread reply in a thread of this bot"
+    return IGNORE, "thread reply in a thread of another bot"
+
+
+def owner_of(event: dict, thread_owner: dict = None, mentions=None):
+    """
+    The one user that should answer a channel message, the same for every bot that receives it: the mentioned user
+    for a new message, and for a thread reply the bot that answered last (or the bot the thread was started with).
+    Returns "" when no bot should answer and None when it can't be decided for all bots at once (several users
+    mentioned, unknown thread), then every bot decides for itself.
+    """
+    if event.get('bot_id') or event.get('channel_type') == "im":
+        return None
+    if mentions is None:
+        mentions = extract_mentions(event.get('text') or '')
+    if len(mentions) > 1:
+        return None
+
+    thread_ts = event.get('thread_ts')
+    if not thread_ts or thread_ts == event.get('ts'):
+        return mentions[0] if mentions else ""
+
+    if thread_owner is None:
+        return None
+    if mentions:
+        mentioned = mentions[0]
+        involved = mentioned in thread_owner['root_mentions'] or thread_owner['last_bot'] == mentioned
+        return mentioned if involved else ""
+    if thread_owner['last_bot']:
+        return thread_owner['last_bot']
+    if len(thread_owner['root_mentions']) == 1:
+        return thread_owner['root_mentions'][0]
+    return None
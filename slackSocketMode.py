@@ -0,0 +1,48 @@
+import logging
+
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.socket_mode.response import SocketModeResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+class SocketModeDispatcher:
+    """
+    Receives the events of bots that have an app level token (app_token in their credentials) over Socket Mode instead
+    of the HTTP events URL, so the deployment needs no public URL. Events go through the same dispatch as the HTTP routes.
+    """
+
+    def __init__(self, bot_registry, dispatch):
+        # dispatch(token_key, payload, retry_num, retry_reason) accepts the event, like the HTTP handler does
+        self.bot_registry = bot_registry
+        self.dispatch = dispatch
+        self.clients = {}
+
+    async def start(self, token_keys):
+        for token_key in token_keys:
+            bot = await self.bot_registry.get(token_key)
+            app_token = bot.credentials.get('app_token') if bot else None
+            if not app_token:
+                logger.warning("No app_token for %s, its events have to come in over HTTP", token_key)
+                continue
+            client = SocketModeClient(app_token=app_token)
+            client.socket_mode_request_listeners.append(self._listener(token_key))
+            await client.connect()
+            self.clients[token_key] = client
+        logger.info("Socket Mode connected for %s/%s bots", len(self.clients), len(token_keys))
+
+    def _listener(self, token_key: str):
+        async def listener(client, req):
+            if req.type == "events_api":
+                response = await self.dispatch(token_key, req.payload, req.retry_attempt, req.retry_reason)
+                if getattr(response, 'status_code', 200) == 503:
+                    # Worker pool is full, without the ack slack sends the event again
+                    return
+            await client.send_socket_mode_response(SocketModeResponse(envelope_id=req.envelope_id))
+        return listener
+
+    async def stop(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
@@ -0,0 +1,270 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+# One thread per SQLite file, shared by all the stores in it: their writes never wait for each other's locks
+_sqlite_executors = {}
+
+
+def make_key(key) -> str:
+    # Tuple keys like (token_key, event_id) are stored as "token_key:event_id"
+    if isinstance(key, (tuple, list)):
+        return ":".join(str(part) for part in key)
+    return str(key)
+
+
+class MemoryStore:
+    """
+    In-process LRU store with TTL eviction, capped at max_entries so it can't grow for the life of the container.
+    The methods are coroutines like the other backends', they never wait on anything.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, default=None):
+        key = make_key(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    async def set(self, key, value, ttl_seconds: float = None):
+        key = make_key(key)
+        with self._lock:
+            self._set(key, value, ttl_seconds)
+
+    async def add(self, key, value=True, ttl_seconds: float = None) -> bool:
+        """
+        Store the value only if the key is not there yet, returns False if it already was (used for claiming events)
+        """
+        key = make_key(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._set(key, value, ttl_seconds)
+            return True
+
+    async def delete(self, key):
+        with self._lock:
+            self._entries.pop(make_key(key), None)
+
+    def _set(self, key, value, ttl_seconds):
+        expires_at = time.time() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def sqlite_executor(path: str) -> concurrent.futures.ThreadPoolExecutor:
+    path = os.path.abspath(path)
+    if path not in _sqlite_executors:
+        _sqlite_executors[path] = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="slack-sqlite")
+    return _sqlite_executors[path]
+
+
+class SQLiteStore:
+    """
+    Store backed by a SQLite file, values are saved as JSON. Keeps state across restarts of one replica without any
+    extra service, and can be shared by processes on the same host, but not between replicas: WAL mode needs shared
+    memory on one host and doesn't work on network filesystems (NFS, Azure Files ...), use redis for that.
+    Queries run on a thread of the file's own so a busy database never blocks the event loop.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl_seconds: float = 3600, max_entries: int = 100000):
+        self.path = path
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self._executor = sqlite_executor(path)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv_store ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_store_expires ON kv_store (namespace, expires_at)")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def get(self, key, default=None):
+        row = await self._run(self._get, key)
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(row[0])
+
+    async def set(self, key, value, ttl_seconds: float = None):
+        await self._run(self._set, key, value, ttl_seconds)
+
+    async def add(self, key, value=True, ttl_seconds: float = None) -> bool:
+        added = await self._run(self._add, key, value, ttl_seconds)
+        if added:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return added
+
+    async def delete(self, key):
+        await self._run(self._delete, key)
+
+    def _get(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT value FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (self.namespace, make_key(key), time.time())
+            ).fetchone()
+
+    def _set(self, key, value, ttl_seconds):
+        expires_at = time.time() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, make_key(key), json.dumps(value), expires_at)
+            )
+            self._after_write()
+
+    def _add(self, key, value, ttl_seconds) -> bool:
+        now = time.time()
+        expires_at = now + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            # Single statement so two processes can't both claim the same key
+            cursor = self._conn.execute(
+                "INSERT INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE kv_store.expires_at <= ?",
+                (self.namespace, make_key(key), json.dumps(value), expires_at, now)
+            )
+            added = cursor.rowcount > 0
+            if added:
+                self._after_write()
+            return added
+
+    def _delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv_store WHERE namespace = ? AND key = ?", (self.namespace, make_key(key)))
+
+    def _after_write(self):
+        # Purge expired rows and enforce the cap every so often instead of on every write
+        self._writes += 1
+        if self._writes % 500:
+            return
+        self._conn.execute("DELETE FROM kv_store WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+        self._conn.execute(
+            "DELETE FROM kv_store WHERE namespace = ? AND key IN ("
+            "SELECT key FROM kv_store WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries)
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM kv_store WHERE namespace = ? AND expires_at > ?", (self.namespace, time.time())
+            ).fetchone()[0]
+
+
+class RedisStore:
+    """
+    Store backed by Redis, shared between all replicas. Needs the redis package, which is only required for this backend.
+    """
+
+    def __init__(self, url: str, namespace: str, ttl_seconds: float = 3600):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("The redis store backend needs the redis package, run: pip install redis")
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        # asyncio client, a round trip to redis doesn't block the event loop
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    def _redis_key(self, key):
+        return f"slack:{self.namespace}:{make_key(key)}"
+
+    def _ttl_ms(self, ttl_seconds):
+        return max(1, int((self.ttl_seconds if ttl_seconds is None else ttl_seconds) * 1000))
+
+    async def get(self, key, default=None):
+        value = await self._redis.get(self._redis_key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    async def set(self, key, value, ttl_seconds: float = None):
+        await self._redis.set(self._redis_key(key), json.dumps(value), px=self._ttl_ms(ttl_seconds))
+
+    async def add(self, key, value=True, ttl_seconds: float = None) -> bool:
+        added = bool(await self._redis.set(self._redis_key(key), json.dumps(value), px=self._ttl_ms(ttl_seconds), nx=True))
+        if added:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return added
+
+    async def delete(self, key):
+        await self._redis.delete(self._redis_key(key))
+
+
+def create_store(namespace: str, ttl_seconds: float, max_entries: int):
+    """
+    Creates the store for one kind of state (dedup, thread index ...). The backend comes from
+    SLACK_<NAMESPACE>_BACKEND or SLACK_STORE_BACKEND: memory (default), sqlite (one replica) or redis (several replicas).
+    Every backend has the same coroutine methods: get, set, add and delete.
+    """
+    prefix = f"SLACK_{namespace.upper()}"
+    backend = os.getenv(f"{prefix}_BACKEND", os.getenv("SLACK_STORE_BACKEND", "memory")).lower()
+    ttl_seconds = float(os.getenv(f"{prefix}_TTL_SECONDS", ttl_seconds))
+    max_entries = int(os.getenv(f"{prefix}_MAX_ENTRIES", max_entries))
+
+    if backend == "sqlite":
+        path = os.getenv("SLACK_STORE_SQLITE_PATH", "slack_state.db")
+        logger.info("Using sqlite store for %s: %s", namespace, path)
+        return SQLiteStore(path, namespace, ttl_seconds=ttl_seconds, max_entries=max_entries)
+    if backend == "redis":
+        logger.info("Using redis store for %s", namespace)
+        return RedisStore(os.getenv("REDIS_URL", "redis://localhost:6379/0"), namespace, ttl_seconds=ttl_seconds)
+    if backend != "memory":
+        raise ValueError(f"Unknown store backend for {namespace}: {backend}")
+    return MemoryStore(ttl_seconds=ttl_seconds, max_entries=max_entries)
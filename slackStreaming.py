@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import time
+
+from .slackBlocks import MAX_BLOCKS_PER_MESSAGE, MAX_MESSAGE_TEXT, build_messages, format_message, split_text
+
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the bot's streamed lines
+END_OF_STREAM = object()
+
+
+def parse_stream_line(line: str) -> str:
+    """
+    Gets the text out of one streamed line. Supports server-sent events ("data: ..."), JSON lines with a
+    delta/response/text field, and plain text lines.
+    """
+    if not line:
+        return ""
+    if line.startswith("data:"):
+        line = line[5:].strip()
+        if line == "[DONE]":
+            return ""
+    elif line.startswith(("event:", "id:", "retry:", ":")):
+        return ""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return line + "\n"
+    if isinstance(data, dict):
+        return data.get('delta') or data.get('response') or data.get('text') or ""
+    return str(data)
+
+
+async def iter_bot_response(response, executor=None):
+    """
+    Yields the bot's answer as it arrives. Streamed responses (text/event-stream or ndjson) are read line by line in a
+    thread, a normal JSON response is yielded in one piece so the bot backend doesn't have to support streaming.
+    The reading thread is taken from executor, the loop's default executor if None.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    if 'text/event-stream' not in content_type and 'ndjson' not in content_type:
+        # The body of a stream=True response is only read here, off the event loop
+        response_data = await asyncio.get_running_loop().run_in_executor(executor, response.json)
+        if 'response' in response_data:
+            yield response_data['response']
+        else:
+            yield response_data.get('status', 'No response available')
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def read_lines():
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, END_OF_STREAM)
+
+    reader = loop.run_in_executor(executor, read_lines)
+    while True:
+        line = await queue.get()
+        if line is END_OF_STREAM:
+            break
+        chunk = parse_stream_line(line)
+        if chunk:
+            yield chunk
+    # Raises if reading the stream failed
+    await reader
+
+
+class StreamingReply:
+    """
+    Shows the bot's answer while it is being generated by editing the "thinking" placeholder in place.
+    chat.update calls are coalesced to at most one per update_interval, and when the answer gets longer than one
+    message it continues in follow-up messages. finish() renders the final answer the same way as the non streaming mode.
+    """
+
+    def __init__(self, client, channel: str, thread_ts: str, placeholder_ts: str, update_interval: float = 1.0):
+        self.client = client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.update_interval = update_interval
+        # ts of every slack message of this answer, starting with the placeholder
+        self.message_ts = [placeholder_ts]
+        self.text = ""
+        self._shown_text = None
+        self._last_update = 0.0
+        self._pending_flush = None
+        self._flush_started = False
+        self._lock = asyncio.Lock()
+        self.updates = 0
+
+    async def append(self, chunk: str):
+        self.text += chunk
+        wait = self.update_interval - (time.monotonic() - self._last_update)
+        if wait <= 0:
+            await self.flush()
+        elif self._pending_flush is None:
+            # Coalesce everything that arrives until the interval is over into one update
+            self._pending_flush = asyncio.ensure_future(self._flush_later(wait))
+
+    async def _flush_later(self, wait: float):
+        # Stays the pending flush until its update is done, so finish() can wait for it
+        try:
+            await asyncio.sleep(wait)
+            self._flush_started = True
+            await self.flush()
+        except Exception as e:
+            # A failed intermediate update (429 after the retries, msg_too_long) only delays the text, finish() shows all of it
+            logger.error("Error updating the streamed reply: %r", e)
+        finally:
+            self._pending_flush = None
+            self._flush_started = False
+
+    async def _wait_pending_flush(self):
+        pending = self._pending_flush
+        if pending is None:
+            return
+        if not self._flush_started:
+            # Still waiting for its interval, nothing is in flight and finish() shows the text anyway
+            pending.cancel()
+        # asyncio.wait doesn't cancel an update in flight if we are cancelled ourselves
+        await asyncio.wait([pending])
+        # A timer cancelled before it ran never reached its finally
+        self._pending_flush = None
+
+    async def flush(self):
+        async with self._lock:
+            if self.text == self._shown_text:
+                return
+            # Same layout as the final answer: section blocks of at most 3000 characters, 50 blocks per message
+            sections = split_text(format_message(self.text))
+            for index in range(0, max(len(sections), 1), MAX_BLOCKS_PER_MESSAGE):
+                message_index = index // MAX_BLOCKS_PER_MESSAGE
+                if message_index < len(self.message_ts) - 1 and self._shown_text is not None:
+                    # Earlier messages are full and don't change anymore
+                    continue
+                await self._show(message_index, sections[index:index + MAX_BLOCKS_PER_MESSAGE])
+            self._shown_text = self.text
+            self._last_update = time.monotonic()
+
+    async def _show(self, index: int, sections: list):
+        blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": section}} for section in sections]
+        text = "\n\n".join(sections)[:MAX_MESSAGE_TEXT] or "..."
+        if index < len(self.message_ts):
+            await self.client.chat_update(channel=self.channel, ts=self.message_ts[index], text=text, blocks=blocks)
+        else:
+            # The answer rolled over into a new message
+            response = await self.client.chat_postMessage(
+                channel=self.channel,
+                thread_ts=self.thread_ts,
+                text=text,
+                mrkdwn=True,
+                blocks=blocks
+            )
+            self.message_ts.append(response['ts'])
+        self.updates += 1
+
+    async def finish(self, http_client, image_validator, image_deadline: float = 5.0):
+        """
+        Replaces the streamed text with the final formatted answer (text and image blocks), reusing the messages already posted
+        """
+        await self._wait_pending_flush()
+        async with self._lock:
+            reply_messages = await build_messages(self.text, http_client, image_validator, deadline=image_deadline)
+            for index, reply_message in enumerate(reply_messages):
+                if index < len(self.message_ts):
+                    await self.client.chat_update(
+                        channel=self.channel,
+                        ts=self.message_ts[index],
+                        text=reply_message['text'],
+                        blocks=reply_message['blocks']
+                    )
+                else:
+                    response = await self.client.chat_postMessage(
+                        channel=self.channel,
+                        thread_ts=self.thread_ts,
+                        text=reply_message['text'],
+                        mrkdwn=True,
+                        unfurl_links=True,
+                        unfurl_media=True,
+                        blocks=reply_message['blocks']
+                    )
+                    self.message_ts.append(response['ts'])
+            # The final rendering can need fewer messages than the streamed text did
+            for ts in self.message_ts[len(reply_messages):]:
+                try:
+                    await self.client.chat_delete(channel=self.channel, ts=ts)
+                except Exception as e:
+                    logger.error("Error deleting extra streamed message: %s", e)
+            self.message_ts = self.message_ts[:len(reply_messages)]
+        logger.info("Streamed reply finished with %s updates in %s message(s)", self.updates, len(self.message_ts))
@@ -0,0 +1,77 @@
+import logging
+import re
+
+from .slackStores import create_store
+
+
+logger = logging.getLogger(__name__)
+
+# Matches <@U123> and <@U123|name> user mentions
+MENTION_PATTERN = re.compile(r'<@([A-Z0-9]+)(?:\|[^>]*)?>')
+
+
+class ThreadOwnershipIndex:
+    """
+    Keeps who owns a thread, keyed by (channel, thread_ts): the users mentioned in the original message and the last
+    bot that responded. Every bot in a channel receives every message event, so the index is kept up to date from
+    those events and from our own posts, and the thread is only fetched from slack when we haven't seen its start.
+    One index is shared by all the bots of the process, use the redis store backend to share it between replicas.
+    """
+
+    def __init__(self, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 100000):
+        self.store = create_store("threads", ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    async def record_message(self, channel: str, event: dict, mentions):
+        """
+        Updates the index from a message event we received, no slack call needed
+        """
+        thread_ts = event.get('thread_ts')
+        if not thread_ts or thread_ts == event.get('ts'):
+            # Original message of a (future) thread, we know everything about it
+            await self.store.set((channel, event.get('ts')), {"root_mentions": list(mentions), "last_bot": None})
+        elif event.get('bot_id') and event.get('user'):
+            await self.record_bot_reply(channel, thread_ts, event['user'])
+
+    async def record_bot_reply(self, channel: str, thread_ts: str, bot_user_id: str):
+        entry = await self.store.get((channel, thread_ts))
+        if entry is None:
+            # We don't know the original message of this thread, the next lookup fetches it anyway
+            return
+        if entry.get("last_bot") != bot_user_id:
+            entry["last_bot"] = bot_user_id
+            await self.store.set((channel, thread_ts), entry)
+
+    async def peek(self, channel: str, thread_ts: str):
+        """
+        Returns the thread's entry if it is in the index, or None, never calls slack
+        """
+        return await self.store.get((channel, thread_ts))
+
+    async def get(self, client, channel: str, thread_ts: str) -> dict:
+        """
+        Returns {"root_mentions": [...], "last_bot": ...} for the thread, fetching it from slack only on a miss
+        """
+        entry = await self.store.get((channel, thread_ts))
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        thread_messages = await client.conversations_replies(channel=channel, ts=thread_ts)
+        messages = thread_messages.get('messages') or []
+        entry = {"root_mentions": [], "last_bot": None}
+        if messages:
+            entry["root_mentions"] = extract_mentions(messages[0].get('text', ''))
+            for message in messages[1:]:
+                if message.get('bot_id') and message.get('user'):
+                    entry["last_bot"] = message['user']
+        await self.store.set((channel, thread_ts), entry)
+        logger.info("Loaded thread ownership for %s/%s from slack: %s", channel, thread_ts, entry)
+        return entry
+
+
+def extract_mentions(text: str):
+    # Mentioned user ids in order, without duplicates
+    return list(dict.fromkeys(MENTION_PATTERN.findall(text)))
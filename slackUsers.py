@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+
+from slack_sdk.errors import SlackApiError
+
+from .slackStores import create_store
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserProfileCache:
+    """
+    Remembers whether a slack user is a bot, per workspace, so the multi-bot mention check doesn't
+    call users.info for every mention of every message. Unknown users are cached too (for a shorter time).
+    """
+
+    def __init__(self, ttl_seconds: float = 6 * 3600, negative_ttl_seconds: float = 300, max_entries: int = 100000):
+        self.negative_ttl_seconds = float(os.getenv('SLACK_USERS_NEGATIVE_TTL_SECONDS', negative_ttl_seconds))
+        self.store = create_store("users", ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self._lookups = {}
+        self._warmed_teams = set()
+        self._warm_tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def is_bot(self, client, team_id: str, user_id: str):
+        """
+        Returns True/False, or None when the user doesn't exist or slack couldn't be asked
+        """
+        profile = await self.store.get((team_id, user_id))
+        if profile is not None:
+            self.hits += 1
+            return profile.get('is_bot')
+        self.misses += 1
+
+        # Concurrent messages mentioning the same user share one users.info call
+        key = (team_id, user_id)
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            lookup = self._lookups[key] = asyncio.ensure_future(self._fetch(client, team_id, user_id))
+            lookup.add_done_callback(lambda _: self._lookups.pop(key, None))
+        return await asyncio.shield(lookup)
+
+    async def _fetch(self, client, team_id: str, user_id: str):
+        try:
+            user_info = await client.users_info(user=user_id)
+        except SlackApiError as e:
+            if e.response.get('error') == 'user_not_found':
+                await self.store.set((team_id, user_id), {'is_bot': None}, ttl_seconds=self.negative_ttl_seconds)
+            logger.error("Error getting user info for %s: %s", user_id, e)
+            return None
+        is_bot = user_info['user'].get('is_bot', False)
+        await self.store.set((team_id, user_id), {'is_bot': is_bot})
+        return is_bot
+
+    async def count_bots(self, client, team_id: str, user_ids) -> int:
+        # Resolve all mentioned users at the same time instead of one users.info call after the other
+        results = await asyncio.gather(*(self.is_bot(client, team_id, user_id) for user_id in user_ids))
+        return sum(1 for is_bot in results if is_bot)
+
+    async def warm(self, client, team_id: str, page_size: int = 200):
+        """
+        Loads every user of the workspace with users.list, a few paged calls instead of one users.info per mentioned user
+        """
+        if team_id in self._warmed_teams:
+            return
+        self._warmed_teams.add(team_id)
+        cursor = None
+        loaded = 0
+        try:
+            while True:
+                page = await client.users_list(limit=page_size, cursor=cursor)
+                for member in page.get('members', []):
+                    await self.store.set((team_id, member['id']), {'is_bot': member.get('is_bot', False)})
+                    loaded += 1
+                cursor = page.get('response_metadata', {}).get('next_cursor')
+                if not cursor:
+                    break
+            logger.info("Warmed user cache for team %s: %s users", team_id, loaded)
+        except SlackApiError as e:
+            # Lookups just fall back to users.info, try warming again on a later message
+            self._warmed_teams.discard(team_id)
+            logger.error("Error warming user cache for team %s: %s", team_id, e)
+
+    def warm_in_background(self, client, team_id: str):
+        if team_id in self._warmed_teams:
+            return
+        # Keep a reference so the task isn't garbage collected before it finishes
+        task = asyncio.ensure_future(self.warm(client, team_id))
+        self._warm_tasks.add(task)
+        task.add_done_callback(self._warm_tasks.discard)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventWorkerPool:
+    """
+    Bounded pool for processing slack events after they have been acked.
+    Slack retries any event that is not acked within 3 seconds, so the route only verifies and queues the event,
+    the slow part (file uploads, bot call, posting the reply) runs here.
+    """
+
+    def __init__(self, max_workers: int = 16, max_pending: int = 500, per_bot_concurrency: int = 4):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.per_bot_concurrency = per_bot_concurrency
+        self._workers = asyncio.Semaphore(max_workers)
+        self._bot_slots = {}
+        self._tasks = set()
+        self._accepting = True
+        # Backpressure metrics
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_pending_seen = 0
+        self.bot_in_flight = {}
+
+    @property
+    def pending(self):
+        # Jobs accepted but not finished yet (waiting for a slot or running)
+        return len(self._tasks)
+
+    def submit(self, token_key: str, job) -> bool:
+        """
+        Queue a job (a no-argument callable returning an awaitable) for the given bot.
+        Returns False when the pool is full or draining, the caller should then let slack retry later.
+        """
+        if not self._accepting or self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning("Worker pool rejected event for %s, pending: %s", token_key, self.pending)
+            return False
+
+        self.submitted += 1
+        task = asyncio.get_running_loop().create_task(self._run(token_key, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        return True
+
+    async def _run(self, token_key: str, job):
+        bot_slot = self._bot_slots.get(token_key)
+        if bot_slot is None:
+            bot_slot = self._bot_slots[token_key] = asyncio.Semaphore(self.per_bot_concurrency)
+
+        # Take the bot's slot first so a chatty bot waiting for its own slots doesn't hold the shared workers
+        async with bot_slot:
+            async with self._workers:
+                self.in_flight += 1
+                self.bot_in_flight[token_key] = self.bot_in_flight.get(token_key, 0) + 1
+                started = time.monotonic()
+                try:
+                    await job()
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error("Error processing event for %s: %s", token_key, e)
+                finally:
+                    self.in_flight -= 1
+                    self.bot_in_flight[token_key] -= 1
+                    logger.info("Event for %s processed in %.2fs", token_key, time.monotonic() - started)
+
+    async def drain(self, timeout: float = 30.0):
+        """
+        Stop accepting new events and wait for the queued ones to finish, used on shutdown so a deploy doesn't drop replies.
+        """
+        self._accepting = False
+        if not self._tasks:
+            return
+        logger.info("Draining worker pool, pending: %s", self.pending)
+        done, not_done = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            logger.warning("Worker pool drain timed out, cancelled %s events", len(not_done))
+
+    def metrics(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "per_bot_concurrency": self.per_bot_concurrency,
+            "pending": self.pending,
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "max_pending_seen": self.max_pending_seen,
+            "bot_in_flight": {key: count for key, count in self.bot_in_flight.items() if count},
+        }
@@ -0,0 +1,128 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+
+# The modules use relative imports, so they are imported as a package named after the checkout directory
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR.parent))
+slackRouting = importlib.import_module(f"{REPO_DIR.name}.slackRouting")
+
+REPLY, IGNORE, NEEDS_LOOKUP = slackRouting.REPLY, slackRouting.IGNORE, slackRouting.NEEDS_LOOKUP
+
+BOT = "UBOT"
+OTHER_BOT = "UOTHER"
+HUMAN = "UHUMAN"
+ROOT_TS = "1700000000.000100"
+REPLY_TS = "1700000000.000200"
+
+
+def message(text="", user=HUMAN, ts=ROOT_TS, thread_ts=None, channel_type="channel", **fields):
+    event = {"type": "message", "user": user, "text": text, "ts": ts, "channel": "C1", "channel_type": channel_type}
+    if thread_ts:
+        event["thread_ts"] = thread_ts
+    event.update(fields)
+    return event
+
+
+def thread_reply(text="", **fields):
+    return message(text, ts=REPLY_TS, thread_ts=ROOT_TS, **fields)
+
+
+def owner(root_mentions=(), last_bot=None):
+    return {"root_mentions": list(root_mentions), "last_bot": last_bot}
+
+
+@pytest.mark.parametrize("event, bot_user_id, thread_owner, expected", [
+    # Direct messages
+    (message("hello", channel_type="im"), BOT, None, REPLY),
+    (message(f"hello <@{BOT}>", channel_type="im"), BOT, None, REPLY),
+    (message(f"<@{BOT}> and <@{OTHER_BOT}>", channel_type="im"), BOT, None, NEEDS_LOOKUP),
+    # Channel messages
+    (message(f"<@{BOT}> what is this?"), BOT, None, REPLY),
+    (message(f"<@{OTHER_BOT}> what is this?"), BOT, None, IGNORE),
+    (message("just chatting"), BOT, None, IGNORE),
+    # A thread's root message is a channel message
+    (message(f"<@{BOT}> hi", thread_ts=ROOT_TS), BOT, None, REPLY),
+    (message("hi", thread_ts=ROOT_TS), BOT, owner([BOT]), IGNORE),
+    # Thread replies
+    (thread_reply("and then?"), BOT, owner([BOT]), REPLY),
+    (thread_reply("and then?"), BOT, owner([OTHER_BOT], last_bot=BOT), REPLY),
+    (thread_reply("and then?"), BOT, owner([BOT], last_bot=OTHER_BOT), REPLY),
+    (thread_reply("and then?"), BOT, owner([OTHER_BOT], last_bot=OTHER_BOT), IGNORE),
+    (thread_reply("and then?"), BOT, owner(), IGNORE),
+    (thread_reply("and then?"), BOT, None, NEEDS_LOOKUP),
+    (thread_reply(f"<@{BOT}> and then?"), BOT, None, NEEDS_LOOKUP),
+    (thread_reply(f"<@{OTHER_BOT}> and then?"), BOT, owner([BOT]), IGNORE),
+    # Several users mentioned
+    (message(f"<@{BOT}> <@{OTHER_BOT}> compare"), BOT, None, NEEDS_LOOKUP),
+    (message(f"<@{HUMAN}> <@{OTHER_BOT}> compare"), BOT, None, IGNORE),
+    (thread_reply(f"<@{BOT}> <@{OTHER_BOT}> compare"), BOT, owner([BOT]), NEEDS_LOOKUP),
+    (thread_reply(f"<@{HUMAN}> <@{OTHER_BOT}> compare"), BOT, owner([BOT]), IGNORE),
+    # Messages from bots, including this one
+    (message(f"<@{BOT}> hi", user=BOT), BOT, None, IGNORE),
+    (thread_reply("answer", user=BOT), BOT, owner([BOT]), IGNORE),
+    (message(f"<@{BOT}> hi", user=OTHER_BOT, bot_id="B1"), BOT, None, IGNORE),
+    (message("hi", channel_type="im", bot_id="B1"), BOT, None, IGNORE),
+    (message(f"<@{BOT}> hi", bot_id="B1"), None, None, IGNORE),
+    # Bot user id not resolved yet
+    (message(f"<@{BOT}> hi"), None, None, NEEDS_LOOKUP),
+    (message("hello", channel_type="im"), None, None, NEEDS_LOOKUP),
+])
+def test_route_event(event, bot_user_id, thread_owner, expected):
+    decision, reason = slackRouting.route_event(event, bot_user_id, thread_owner)
+    assert decision == expected, reason
+    assert reason
+
+
+def test_route_event_uses_given_mentions():
+    event = message("no mention in the text")
+    assert slackRouting.route_event(event, BOT, None, mentions=[BOT])[0] == REPLY
+    assert slackRouting.route_event(event, BOT, None, mentions=[])[0] == IGNORE
+
+
+@pytest.mark.parametrize("event, thread_owner, expected", [
+    # Every bot decides for itself
+    (message("hello", channel_type="im"), None, None),
+    (message(f"<@{BOT}> hi", bot_id="B1"), None, None),
+    (thread_reply("answer", user=BOT, bot_id="B1"), owner([BOT]), None),
+    (message(f"<@{BOT}> <@{OTHER_BOT}> compare"), None, None),
+    (thread_reply(f"<@{BOT}> <@{OTHER_BOT}> compare"), owner([BOT]), None),
+    (thread_reply("and then?"), None, None),
+    (thread_reply(f"<@{BOT}> and then?"), None, None),
+    (thread_reply("and then?"), owner(), None),
+    (thread_reply("and then?"), owner([BOT, OTHER_BOT]), None),
+    # Channel messages
+    (message(f"<@{BOT}> what is this?"), None, BOT),
+    (message(f"<@{OTHER_BOT}> what is this?"), None, OTHER_BOT),
+    (message("just chatting"), None, ""),
+    (message("hi", thread_ts=ROOT_TS), owner([BOT]), ""),
+    # Thread replies
+    (thread_reply("and then?"), owner([BOT]), BOT),
+    (thread_reply("and then?"), owner([BOT], last_bot=OTHER_BOT), OTHER_BOT),
+    (thread_reply("and then?"), owner([BOT, OTHER_BOT], last_bot=BOT), BOT),
+    (thread_reply(f"<@{OTHER_BOT}> your turn"), owner([OTHER_BOT], last_bot=BOT), OTHER_BOT),
+    (thread_reply(f"<@{OTHER_BOT}> your turn"), owner([BOT], last_bot=BOT), ""),
+    (thread_reply(f"<@{HUMAN}> look"), owner([BOT]), ""),
+])
+def test_owner_of(event, thread_owner, expected):
+    assert slackRouting.owner_of(event, thread_owner) == expected
+
+
+@pytest.mark.parametrize("event, thread_owner", [
+    (message(f"<@{BOT}> what is this?"), None),
+    (message(f"<@{OTHER_BOT}> what is this?"), None),
+    (message("just chatting"), None),
+    (thread_reply("and then?"), owner([BOT])),
+    (thread_reply("and then?"), owner([OTHER_BOT], last_bot=OTHER_BOT)),
+    (thread_reply(f"<@{OTHER_BOT}> your turn"), owner([OTHER_BOT], last_bot=BOT)),
+])
+def test_owner_of_agrees_with_route_event(event, thread_owner):
+    # When owner_of decides for all bots, each bot's own routing comes to the same answer. Not for a thread whose root
+    # mentioned one bot and another bot answered last: both reply on their own, only coordinated routing picks one.
+    expected = slackRouting.owner_of(event, thread_owner)
+    for bot_user_id in (BOT, OTHER_BOT):
+        decision, _ = slackRouting.route_event(event, bot_user_id, thread_owner)
+        assert (decision == REPLY) == (bot_user_id == expected)